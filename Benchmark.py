@@ -0,0 +1,221 @@
+"""Offline end to end benchmark of Fetch2.py.
+
+Generates tile logs with power law tile popularity and synthetic countries,
+serves them over a local HTTP stand-in for planet.openstreetmap.org,
+Overpass and polygons.openstreetmap.fr, then runs ``Fetch2.process_all``
+against it::
+
+    python3 Benchmark.py --lines=1000000 --days=2 --workers=2
+
+The work folder keeps the logs, the downloaded dumps and the Fetch2 caches,
+a second run with the same folder measures warm caches.
+"""
+import argparse
+import datetime
+import http.server
+import lzma
+import math
+import os
+import re
+import string
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import shapely
+import shapely.geometry
+
+import Fetch2
+
+
+MAX_LAT = 85.0511
+PLACES = 100000
+PLACES_EXPONENT = 1.1
+COUNT_EXPONENT = 1.8
+# share of the lines of each zoom, from 0 to 19
+ZOOM_WEIGHTS = np.array([1, 1, 1, 2, 2, 3, 4, 5, 6, 8, 10, 12, 14, 16, 18, 20, 22, 20, 10, 4], dtype=float)
+CHUNK_LINES = 1000000
+FIRST_OSM_ID = 10000000
+LOGS_PATH = '/tile_logs/'
+# a fixed port keeps the URLs, and so the Fetch2 cache keys, of the runs
+PORT = 8765
+
+
+def tiles_of(lons, lats, zs):
+    # the tile of each point at its zoom, as mercantile.tile
+    lats = np.radians(np.clip(lats, -MAX_LAT, MAX_LAT))
+    z2 = np.ldexp(1.0, zs)
+    xs = np.floor((lons + 180.0) / 360.0 * z2)
+    ys = np.floor((1.0 - np.log(np.tan(lats) + 1.0 / np.cos(lats)) / math.pi) / 2.0 * z2)
+    return (np.clip(xs, 0, z2 - 1).astype(np.int64),
+            np.clip(ys, 0, z2 - 1).astype(np.int64))
+
+
+def generate_tile_log(file_name, lines, seed=0, places=PLACES):
+    """Writes about ``lines`` ``z/x/y count`` lines to an xz tile log.
+
+    Views cluster around ``places`` with a Zipf popularity, the tiles of a
+    chunk of CHUNK_LINES lines are distinct and sorted like in the real logs.
+    """
+    rng = np.random.default_rng(seed)
+    place_lons = rng.uniform(-180, 180, places)
+    place_lats = np.degrees(np.arcsin(rng.uniform(-0.95, 0.95, places)))
+    weights = 1.0 / np.arange(1, places + 1) ** PLACES_EXPONENT
+    weights /= weights.sum()
+    zoom_weights = ZOOM_WEIGHTS / ZOOM_WEIGHTS.sum()
+
+    with lzma.open(file_name, 'wb', preset=0) as file:
+        for start in range(0, lines, CHUNK_LINES):
+            size = min(CHUNK_LINES, lines - start)
+            place = rng.choice(places, size, p=weights)
+            zs = rng.choice(len(zoom_weights), size, p=zoom_weights)
+            # views spread around a place, less on higher zooms
+            spread = 2.0 ** (6 - zs / 2.0)
+            xs, ys = tiles_of(place_lons[place] + rng.normal(0, spread),
+                              place_lats[place] + rng.normal(0, spread / 2), zs)
+            counts = np.minimum(rng.zipf(COUNT_EXPONENT, size), 1000000)
+            keys, inverse = np.unique((zs << 40) | (xs << 20) | ys, return_inverse=True)
+            counts = np.bincount(inverse.reshape(-1), weights=counts).astype(np.int64)
+            file.write(''.join(
+                '%d/%d/%d %d\n' % row for row in zip(
+                    (keys >> 40).tolist(), ((keys >> 20) & 0xfffff).tolist(),
+                    (keys & 0xfffff).tolist(), counts.tolist())).encode())
+
+
+def generate_countries(count, seed=0):
+    """Irregular countries tiling the land between the polar circles, by osm id."""
+    rng = np.random.default_rng(seed)
+    points = shapely.multipoints(np.column_stack([rng.uniform(-180, 180, count),
+                                                  rng.uniform(-66, 66, count)]))
+    bounds = shapely.geometry.box(-180, -66, 180, 66)
+    cells = shapely.get_parts(shapely.voronoi_polygons(points, extend_to=bounds))
+    # more vertices make the boundaries as costly to test as real ones
+    cells = shapely.segmentize(shapely.intersection(cells, bounds), 0.1)
+    isos = [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+    return {FIRST_OSM_ID + i: (isos[i % len(isos)], cell) for i, cell in enumerate(cells.tolist())}
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """Local server with the tile logs of ``folder`` and the ``countries``."""
+
+    daemon_threads = True
+
+    def __init__(self, folder, countries, address=('127.0.0.1', PORT)):
+        super(StandIn, self).__init__(address, _StandInHandler)
+        self.folder = folder
+        self.countries = countries
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, status=200, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        # Overpass, the countries or the queried relation
+        query = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        relation = re.search(r'relation\((\d+)\)', query.get('data', [''])[0])
+        rows = ['@id\tISO3166-1\tISO3166-1:alpha2']
+        for osm_id, (iso, _) in sorted(self.server.countries.items()):
+            if relation is None or int(relation.group(1)) == osm_id:
+                rows.append('%s\t\t%s' % (osm_id, iso))
+        self._send(('\n'.join(rows) + '\n').encode())
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path == LOGS_PATH:
+            links = ''.join('<a href="%s">%s</a>\n' % (name, name)
+                            for name in sorted(os.listdir(self.server.folder)))
+            self._send(('<html><body>\n%s</body></html>' % links).encode())
+        elif parts.path.startswith(LOGS_PATH):
+            self._send_file(os.path.join(self.server.folder, os.path.basename(parts.path)))
+        elif parts.path == '/get_wkt.py':
+            osm_id = int(urllib.parse.parse_qs(parts.query)['id'][0])
+            self._send(('SRID=4326;%s' % self.server.countries[osm_id][1].wkt).encode())
+        else:
+            self._send(b'', 404)
+
+    def _send_file(self, file_name):
+        if not os.path.exists(file_name):
+            self._send(b'', 404)
+            return
+        with open(file_name, 'rb') as file:
+            data = file.read()
+        ranges = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if ranges is None:
+            self._send(data)
+            return
+        offset = int(ranges.group(1))
+        if offset >= len(data):
+            self._send(b'', 416)
+            return
+        self._send(data[offset:], 206,
+                   [('Content-Range', 'bytes %s-%s/%s' % (offset, len(data) - 1, len(data)))])
+
+
+def benchmark(folder, lines, days, countries=200, workers=None, output_format='csv',
+              metrics=None, port=PORT):
+    folder = os.path.abspath(folder)
+    logs_folder = os.path.join(folder, 'logs-%s' % lines)
+    os.makedirs(logs_folder, exist_ok=True)
+    first_day = datetime.date(2016, 1, 1)
+    dates = [str(first_day + datetime.timedelta(days=day)) for day in range(days)]
+    for day, date in enumerate(dates):
+        file_name = os.path.join(logs_folder, 'tiles-%s.txt.xz' % date)
+        if not os.path.exists(file_name):
+            start = time.perf_counter()
+            generate_tile_log(file_name + '.part', lines, seed=day)
+            os.replace(file_name + '.part', file_name)
+            Fetch2.Stat().log('generated %s in %.1fs', file_name, time.perf_counter() - start)
+
+    server = StandIn(logs_folder, {osm_id: (iso, geom) for osm_id, (iso, geom)
+                                   in generate_countries(countries).items()},
+                     ('127.0.0.1', port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Fetch2.LOGS_URL = server.url + LOGS_PATH
+    Fetch2.OVERPASS_URL = server.url + '/api/interpreter'
+    Fetch2.FETCH_GEOMETRY_LINK = server.url + '/get_wkt.py?id=%s&params=0'
+    Fetch2.PREFETCH_GEOMETRY_LINK = server.url + '/?id=%s'
+    # Fetch2 keeps its caches and dumps in the current folder, one work folder per benchmark
+    work_folder = os.path.join(folder, 'work-%s-%s' % (lines, countries))
+    os.makedirs(work_folder, exist_ok=True)
+    os.chdir(work_folder)
+    try:
+        start = time.perf_counter()
+        with open(os.devnull, 'wb') as out:
+            Fetch2.process_all(out, dates[0], dates[-1], workers=workers,
+                               output_format=output_format, metrics=metrics)
+        wall = time.perf_counter() - start
+    finally:
+        server.shutdown()
+    Fetch2.Stat().log('benchmark %s lines x %s days: %.1fs, %d lines/s',
+                      lines, days, wall, lines * days / wall)
+    return wall
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Fetch2.py on synthetic tile logs.')
+    parser.add_argument('--folder', default='benchmark', help='work folder for logs and caches')
+    parser.add_argument('--lines', type=int, default=1000000, help='lines per day (about)')
+    parser.add_argument('--days', type=int, default=1, help='days of tile logs')
+    parser.add_argument('--countries', type=int, default=200, help='synthetic countries')
+    parser.add_argument('--workers', type=int, default=None, help='process days in parallel with N processes')
+    parser.add_argument('--format', dest='output_format', choices=Fetch2.OUTPUT_FORMATS, default='csv')
+    parser.add_argument('--metrics', default=None, help='append JSON lines of metrics to this file')
+    parser.add_argument('--port', type=int, default=PORT, help='port of the local stand-in server')
+    benchmark(**parser.parse_args().__dict__)
@@ -1,97 +1,103 @@
 import argparse
+import collections
 import itertools
 import json
-import collections
 import datetime
+import io
+import multiprocessing
 import sys
 
-import mercantile
+import numpy as np
+import pandas as pd
+import shapely
 import shapely.geometry
+import shapely.strtree
+
+import Tile_Records
+import Tiles
 
 
 MIN_DATE = '0000-00-00'
 MAX_DATE = '9999-99-99'
 MIN_ZOOM = 0
 MAX_ZOOM = 19
-
-cache_down = {}
-cache_up = {}
-cache_center = {}
-cache_date = {}
-cache_in_bound = {}
+OUTPUT_FORMATS = ('csv', 'records')
+CHUNK_LINES = 1000000
+INPUT_FIELDS = ('date', 'z', 'x', 'y', 'count', 'lat', 'lon', 'countries')
+# x and y offsets of the children of a tile, in the order of mercantile.children
+CHILD_DX = np.array([0, 1, 1, 0], dtype=np.int64)
+CHILD_DY = np.array([0, 0, 1, 1], dtype=np.int64)
+FIELD_TYPES = {
+    'data': Tile_Records.DICTIONARY,
+    'count': '<i8',
+    'z': '<u1',
+    'x': '<u4',
+    'y': '<u4',
+    'lat': '<f8',
+    'lon': '<f8',
+    'per_day': '<f8',
+    'countries': Tile_Records.DICTIONARY,
+    'extra': Tile_Records.DICTIONARY,
+}
+
+# Filters and boundaries of split, inherited by the forked date workers
+_worker_state = {}
 
 
 def get_down_tiles(x, y, z, target_zoom):
+    # Tiles of target_zoom inside x, y, z in mercantile.children order, see to_subzooms for arrays
     assert z <= target_zoom, 'target zoom less than zoom %s <= %s' % (z, target_zoom)
-    k = (x, y, z, target_zoom)
-    if k not in cache_down:
-        if z == target_zoom:
-            result = [(x, y, z)]
-        else:
-            result = []
-            for t in mercantile.children(x, y, z):
-                result += get_down_tiles(t.x, t.y, t.z, target_zoom)
-        cache_down[k] = tuple(result)
-        return result
-    return cache_down[k]
+    zs, xs, ys, _rows = to_subzooms(np.array([z]), np.array([x]), np.array([y]), target_zoom, target_zoom)
+    return tuple(zip(xs.tolist(), ys.tolist(), zs.tolist()))
 
 
 def get_up_tile(x, y, z, target_zoom):
-    assert z >= target_zoom, 'target zoom more than zoom %s >= %s' % (z, target_zoom)
-    k = (x, y, z, target_zoom)
-    if k not in cache_up:
-        if z == target_zoom:
-            result = (x, y, z)
-        else:
-            t = mercantile.parent(x, y, z)
-            result = get_up_tile(t.x, t.y, t.z, target_zoom)
-        cache_up[k] = result
-        return result
-    return cache_up[k]
+    # Works on scalars and on arrays of tiles of zoom z
+    assert np.all(z >= target_zoom), 'target zoom more than zoom %s >= %s' % (z, target_zoom)
+    return x >> (z - target_zoom), y >> (z - target_zoom), target_zoom
 
 
 def get_date_precision(date, date_prec, date_prec_measure):
-    if date not in cache_date:
-        old_date = date
-        if date_prec_measure == 'd':
-            old_part = int(date[8:])
-            new_part = old_part // date_prec * date_prec + (1 if old_part % date_prec else 0)
-            date = '%s-%02d' % (date[:7], new_part)
-        elif date_prec_measure == 'm':
-            old_part = int(date[5:7])
-            new_part = old_part // date_prec * date_prec + (1 if old_part % date_prec else 0)
-            date = '%s-%02d-01' % (date[:4], new_part)
-        elif date_prec_measure == 'y':
-            old_part = int(date[:4])
-            new_part = old_part // date_prec * date_prec + (1 if old_part % date_prec else 0)
-            date = '%04d-01-01' % (new_part)
-        else:
-            raise TypeError('unknown date precision measure %s' % date_prec_measure)
-        cache_date[old_date] = date
-        return date
-    return cache_date[date]
+    if date_prec_measure == 'd':
+        old_part = int(date[8:])
+        new_part = old_part // date_prec * date_prec + (1 if old_part % date_prec else 0)
+        return '%s-%02d' % (date[:7], new_part)
+    elif date_prec_measure == 'm':
+        old_part = int(date[5:7])
+        new_part = old_part // date_prec * date_prec + (1 if old_part % date_prec else 0)
+        return '%s-%02d-01' % (date[:4], new_part)
+    elif date_prec_measure == 'y':
+        old_part = int(date[:4])
+        new_part = old_part // date_prec * date_prec + (1 if old_part % date_prec else 0)
+        return '%04d-01-01' % (new_part)
+    raise TypeError('unknown date precision measure %s' % date_prec_measure)
 
 
 def calculate_center(x, y, z):
-    k = (x, y, z)
-    if k not in cache_center:
-        bounds = mercantile.bounds(x, y, z)
-        height = bounds.north - bounds.south
-        width = bounds.east - bounds.west
-        center = (bounds.north + height / 2, bounds.west + width / 2)
-        cache_center[k] = center
-        return center
-    return cache_center[k]
-
-
-def in_boundaries(k, lat, lon, boundary, west, south, east, north):
-    if k not in cache_in_bound:
-        in_bounds = lat < north and lat > south and lon > west and lon < east
-        if in_bounds:
-            in_bounds = boundary.contains(shapely.geometry.Point(lon, lat))
-        cache_in_bound[k] = in_bounds
-        return in_bounds
-    return cache_in_bound[k]
+    # Works on scalars and on arrays of tiles, see Tiles.tiles_centers
+    xs, ys, zs = np.broadcast_arrays(np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64),
+                                     np.asarray(z, dtype=np.int64))
+    lat, lon = Tiles.tiles_centers(zs.reshape(-1), xs.reshape(-1), ys.reshape(-1))
+    if xs.ndim == 0:
+        return float(lat[0]), float(lon[0])
+    return lat.reshape(xs.shape), lon.reshape(xs.shape)
+
+
+class BoundaryIndex(object):
+    """STRtree over the prepared ``--boundaries`` geometries and their extras."""
+
+    def __init__(self, boundaries, extras):
+        self.geoms = np.array(boundaries, dtype=object)
+        self.extras = list(extras)
+        shapely.prepare(self.geoms)
+        self.tree = shapely.strtree.STRtree(self.geoms)
+
+    def query(self, lats, lons):
+        # one tree query for all points, returns the indexes of the points and of the boundaries
+        # containing them, by point and then in the order of the boundaries
+        point_idx, boundary_idx = self.tree.query(shapely.points(lons, lats), predicate='within')
+        order = np.lexsort((boundary_idx, point_idx))
+        return point_idx[order], boundary_idx[order]
 
 
 FIELD_VALUES = (
@@ -111,8 +117,138 @@ FIELD_VALUES = (
 )
 
 
-def flush_fields(stdout, date, count, z, x, y, lat, lon, countries, extra, headers=False, **kwargs):
-    # Filters fields to go into the output file based on the input conditions and writes them out
+def read_chunks(stdin):
+    # Yields date, z, x, y, count and countries columns of the CSV lines or tile records of Fetch2.py
+    if Tile_Records.is_records(stdin):
+        for _fields, columns in Tile_Records.read_chunks(stdin):
+            yield (columns['date'], columns['z'].astype(np.int64), columns['x'].astype(np.int64),
+                   columns['y'].astype(np.int64), columns['count'].astype(np.int64),
+                   columns['countries'])
+        return
+    try:
+        reader = pd.read_csv(stdin, header=None, names=INPUT_FIELDS, keep_default_na=False,
+                             dtype={'date': str, 'z': np.int64, 'x': np.int64, 'y': np.int64,
+                                    'count': np.int64, 'countries': str},
+                             usecols=['date', 'z', 'x', 'y', 'count', 'countries'],
+                             chunksize=CHUNK_LINES)
+    except ValueError:
+        # no lines at all
+        return
+    for frame in reader:
+        yield (frame['date'].values, frame['z'].values, frame['x'].values,
+               frame['y'].values, frame['count'].values, frame['countries'].values)
+
+
+def to_subzooms(zs, xs, ys, min_subz, max_subz):
+    # Tiles below min_subz are replaced by their min_subz tiles in mercantile.children order,
+    # tiles above max_subz by their max_subz tile; returns the tiles and the input row of each
+    down = np.maximum(min_subz - zs, 0)
+    reps = 1 << (2 * down)
+    rows = np.repeat(np.arange(len(zs)), reps)
+    down = down[rows]
+    # position of a tile among the tiles of its row, its base 4 digits are the children taken
+    pos = np.arange(len(rows)) - np.repeat(np.cumsum(reps) - reps, reps)
+    xs = xs[rows] << down
+    ys = ys[rows] << down
+    for level in range(int(down.max()) if len(down) else 0):
+        shift = np.maximum(down - 1 - level, 0)
+        child = np.where(down > level, (pos >> (2 * shift)) & 3, 0)
+        xs += CHILD_DX[child] << shift
+        ys += CHILD_DY[child] << shift
+    zs = np.maximum(zs[rows], min_subz)
+
+    up = np.maximum(zs - max_subz, 0)
+    return np.minimum(zs, max_subz), xs >> up, ys >> up, rows
+
+
+def _spread_bits(values):
+    # Moves the bits of 32 bit values to the even bits
+    values = (values | (values << 16)) & 0x0000ffff0000ffff
+    values = (values | (values << 8)) & 0x00ff00ff00ff00ff
+    values = (values | (values << 4)) & 0x0f0f0f0f0f0f0f0f
+    values = (values | (values << 2)) & 0x3333333333333333
+    return (values | (values << 1)) & 0x5555555555555555
+
+
+def _compact_bits(values):
+    # Inverse of _spread_bits
+    values = values & 0x5555555555555555
+    values = (values | (values >> 1)) & 0x3333333333333333
+    values = (values | (values >> 2)) & 0x0f0f0f0f0f0f0f0f
+    values = (values | (values >> 4)) & 0x00ff00ff00ff00ff
+    values = (values | (values >> 8)) & 0x0000ffff0000ffff
+    return (values | (values >> 16)) & 0x00000000ffffffff
+
+
+def pack_tiles(country_ids, zs, xs, ys):
+    # Country id in the high 21 bits, then 5 bits of zoom and the 38 bits Morton code of x and y
+    return (country_ids << 43) | (zs << 38) | (_spread_bits(xs) << 1) | _spread_bits(ys)
+
+
+def unpack_tiles(keys):
+    return (keys >> 43, (keys >> 38) & 0x1f,
+            _compact_bits(keys >> 1) & 0x7ffff, _compact_bits(keys) & 0x7ffff)
+
+
+class TileCounts(object):
+    """Views of the tiles of one date, as arrays of packed tile keys and
+    counts in order of first appearance.
+
+    Countries are interned to small ids shared by the TileCounts of a run.
+    """
+
+    def __init__(self, country_ids=None, countries=None):
+        self.date = None
+        self.country_ids = {} if country_ids is None else country_ids
+        self.countries = [] if countries is None else countries
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def empty(self):
+        return TileCounts(self.country_ids, self.countries)
+
+    def intern(self, countries):
+        # Ids of the countries, as an array
+        for country in countries:
+            if country not in self.country_ids:
+                self.country_ids[country] = len(self.countries)
+                self.countries.append(country)
+        return np.array([self.country_ids[country] for country in countries], dtype=np.int64)
+
+    def add(self, date, zs, xs, ys, country_ids, counts):
+        self.date = date
+        keys, first, inverse = np.unique(pack_tiles(country_ids, zs, xs, ys),
+                                         return_index=True, return_inverse=True)
+        # float sums are exact below 2 ** 53 views
+        sums = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(keys)).astype(np.int64)
+        order = np.argsort(first, kind='stable')
+        keys, sums = keys[order], sums[order]
+
+        sorter = np.argsort(self.keys)
+        found = np.searchsorted(self.keys, keys, sorter=sorter)
+        known = found < len(self.keys)
+        known[known] = self.keys[sorter[found[known]]] == keys[known]
+        np.add.at(self.counts, sorter[found[known]], sums[known])
+        self.keys = np.concatenate([self.keys, keys[~known]])
+        self.counts = np.concatenate([self.counts, sums[~known]])
+
+    def arrays(self):
+        country_ids, zs, xs, ys = unpack_tiles(self.keys)
+        return zs, xs, ys, country_ids, self.counts
+
+
+def record_fields(extras, **kwargs):
+    # Fields of the tile records output, in the same order as the CSV columns
+    fields = [[field, FIELD_TYPES[field]] for field, applier, filters in FIELD_VALUES
+              if not any(kwargs.get(filter) for filter in filters)]
+    if extras:
+        fields.append(['extra', FIELD_TYPES['extra']])
+    return fields
+
+
+def flush_fields(stdout, date, count, z, x, y, lat, lon, countries, extra, headers=False, rows=None, **kwargs):
+    # Filters fields to go into the output file based on the input conditions and writes them out,
+    # or appends them to rows when given
     k = '%s/%s/%s' % (z, x, y)
     values = []
     for field, applier, filters in FIELD_VALUES:
@@ -125,31 +261,105 @@ def flush_fields(stdout, date, count, z, x, y, lat, lon, countries, extra, heade
 
     if extra is not None:
         values.append(extra)
+    if rows is not None:
+        rows.append(values)
+        return
     stdout.write(('%s\n' % ','.join(str(value) for value in values)).encode())
 
 
-def flush(stdout, tiles, min_count, max_count, boundaries, **kwargs):
+def flush(stdout, tiles, min_count, max_count, boundaries, fields=None, **kwargs):
     # Filters out places with count less than or greater than specified
     # Recalculates the center of the tile date,z,x,y
-    # writes out the tiles
+    # writes out the tiles, as one tile records chunk if the record fields are given
     # if a boundary is specified, flush only those field inside the boundary
-    for k, count in tiles.items():
-        if min_count and count < min_count:
-            continue
-        if max_count and count > max_count:
-            continue
-
-        date, z, x, y, countries = k
-        lat, lon = calculate_center(x, y, z)
-        if boundaries is None:
-            flush_fields(stdout, date, count, z, x, y, lat, lon, countries, None, **kwargs)
-            continue
-        for boundary, boundary_bounds, extra, hash in boundaries:
-            cache_key = '%s/%s/%s' % (lat, lon, hash)
-            if not in_boundaries(cache_key, lat, lon, boundary, *boundary_bounds):
+    if fields is not None:
+        kwargs['rows'] = []
+    zs, xs, ys, country_ids, counts = tiles.arrays()
+    keep = np.ones(len(counts), dtype=bool)
+    if min_count:
+        keep &= counts >= min_count
+    if max_count:
+        keep &= counts <= max_count
+    date = tiles.date
+    zs, xs, ys, country_ids, counts = zs[keep], xs[keep], ys[keep], country_ids[keep], counts[keep]
+    lats, lons = calculate_center(xs, ys, zs)
+    extras = itertools.repeat(None)
+    if boundaries is not None:
+        # a tile is written once per boundary containing its center
+        rows, boundary_idx = boundaries.query(lats, lons)
+        zs, xs, ys, lats, lons = zs[rows], xs[rows], ys[rows], lats[rows], lons[rows]
+        country_ids, counts = country_ids[rows], counts[rows]
+        extras = [boundaries.extras[b] for b in boundary_idx.tolist()]
+    for z, x, y, lat, lon, country_id, count, extra in zip(zs.tolist(), xs.tolist(), ys.tolist(),
+                                                           lats.tolist(), lons.tolist(),
+                                                           country_ids.tolist(), counts.tolist(), extras):
+        flush_fields(stdout, date, count, z, x, y, lat, lon, tiles.countries[country_id], extra, **kwargs)
+    if fields is not None and kwargs['rows']:
+        Tile_Records.write_chunk(stdout, fields, {
+            name: column for (name, _type), column in zip(fields, zip(*kwargs['rows']))})
+    return tiles.empty()
+
+
+def date_runs(stdin, tiles, date_from, date_to, min_zoom, max_zoom, date_precision=None):
+    # Yields the flush date, the interned countries and the zs, xs, ys, country ids and counts of
+    # each run of rows of the same flush date; date_precision is the (date_prec, date_prec_measure) pair
+    for dates, zs, xs, ys, counts, countries in read_chunks(stdin):
+        # Check the date and zoom ranges and the date precision once per distinct date
+        unique_dates, date_codes = np.unique(dates, return_inverse=True)
+        date_codes = date_codes.reshape(-1)
+        in_range = np.array([date_from <= date <= date_to for date in unique_dates.tolist()], dtype=bool)
+        keep = in_range[date_codes] & (min_zoom <= zs) & (zs <= max_zoom)
+        if date_precision:
+            flush_dates = [get_date_precision(date, *date_precision) for date in unique_dates.tolist()]
+        else:
+            flush_dates = unique_dates.tolist()
+        flush_dates, flush_codes = np.unique(np.array(flush_dates, dtype=object), return_inverse=True)
+        flush_codes = flush_codes.reshape(-1)[date_codes[keep]]
+        zs, xs, ys, counts = zs[keep], xs[keep], ys[keep], counts[keep]
+        countries, country_codes = np.unique(countries[keep], return_inverse=True)
+        country_ids = tiles.intern(countries.tolist())[country_codes.reshape(-1)]
+
+        # This assumes that input is grouped by date, rows of a date are aggregated at once.
+        bounds = [0] + (np.flatnonzero(flush_codes[1:] != flush_codes[:-1]) + 1).tolist() + [len(zs)]
+        for run_start, run_end in zip(bounds[:-1], bounds[1:]):
+            if run_start == run_end:
                 continue
-            flush_fields(stdout, date, count, z, x, y, lat, lon, countries, extra, **kwargs)
-    return collections.defaultdict(int)
+            run = slice(run_start, run_end)
+            yield (flush_dates[flush_codes[run_start]], tiles.countries,
+                   (zs[run], xs[run], ys[run], country_ids[run], counts[run]))
+
+
+def date_blocks(runs):
+    # Groups the runs of date_runs into one block of date, countries and runs per flush date
+    block_date, block = None, []
+    for date, countries, run in runs:
+        if block and date != block_date:
+            yield block_date, list(countries), block
+            block = []
+        block_date = date
+        block.append(run)
+    if block:
+        yield block_date, list(countries), block
+
+
+def add_run(tiles, date, run, min_subz, max_subz):
+    zs, xs, ys, country_ids, counts = run
+    sub_zs, sub_xs, sub_ys, rows = to_subzooms(zs, xs, ys, min_subz, max_subz)
+    tiles.add(date, sub_zs, sub_xs, sub_ys, country_ids[rows], counts[rows])
+
+
+def _flush_block_worker(block):
+    # Aggregates and filters the tiles of one flush date, returns their output
+    state = _worker_state
+    date, countries, runs = block
+    start = datetime.datetime.now()
+    tiles = TileCounts(countries=countries)
+    for run in runs:
+        add_run(tiles, date, run, state['min_subz'], state['max_subz'])
+    sys.stderr.write('%s - %s\n' % (date, datetime.datetime.now() - start))
+    out = io.BytesIO()
+    flush(out, tiles, state['min_count'], state['max_count'], state['boundaries'], **state['kwargs'])
+    return out.getvalue()
 
 
 def split(stdin, stdout, date_precision=None, per_day=False,
@@ -158,7 +368,7 @@ def split(stdin, stdout, date_precision=None, per_day=False,
           min_count=None, max_count=None,
           min_zoom=None, max_zoom=None,
           min_subz=None, max_subz=None,
-          extras=tuple(), extra_header=None, **kwargs):
+          extras=tuple(), extra_header=None, output_format='csv', workers=None, **kwargs):
 
     # Calculate the total days if a range has been specified
     if not kwargs.get('no_per_day'):
@@ -169,21 +379,25 @@ def split(stdin, stdout, date_precision=None, per_day=False,
         assert date_from_parsed < date_to_parsed
         kwargs['days'] = (date_to_parsed - date_from_parsed).days
 
-    # Print out the headers in the file
-    if not kwargs.get('no_header'):
+    # Print out the headers in the file, tile records always start with theirs
+    if output_format == 'records':
+        kwargs['fields'] = record_fields(extras, **kwargs)
+        Tile_Records.write_header(stdout, kwargs['fields'])
+    elif not kwargs.get('no_header'):
         flush_fields(stdout, 'date', 'count', 'z', 'x', 'y', 'lat', 'lon', 'countries',
                      ','.join(extras) or None, headers=True, **kwargs)
 
     boudaries_geom = []
+    boundary_extras = []
     # In case a geo boundary is specified, convert it into geometry with a buffer.
-    # The code related to filtering places inside a specified boundary is untested at the moment.
     for boundary, extra in itertools.zip_longest(boundaries, extras):
         if isinstance(boundary, str):
             boundary = shapely.geometry.shape(json.load(open(boundary)))
         if boundary_buffer is not None:
             boundary = boundary.buffer(boundary_buffer)
-        boudaries_geom.append((boundary, boundary.bounds, extra, id(boundary)))
-    boudaries_geom = boudaries_geom or None
+        boudaries_geom.append(boundary)
+        boundary_extras.append(extra)
+    boudaries_geom = boudaries_geom and BoundaryIndex(boudaries_geom, boundary_extras) or None
 
     if date_precision:
         date_prec = float(date_precision[:-1])
@@ -199,46 +413,43 @@ def split(stdin, stdout, date_precision=None, per_day=False,
     assert min_zoom <= max_zoom
     assert min_subz <= max_subz
 
-    # initialize empty tiles, start time and date processed first
-    tiles = flush(stdout, {}, min_count, max_count, boudaries_geom, **kwargs)
+    # initialize empty tiles, their countries are interned while reading
+    tiles = TileCounts()
+    runs = date_runs(stdin, tiles, date_from, date_to, min_zoom, max_zoom,
+                     date_precision and (date_prec, date_prec_measure))
+    if workers and workers > 1:
+        _worker_state.update(min_subz=min_subz, max_subz=max_subz, min_count=min_count,
+                             max_count=max_count, boundaries=boudaries_geom, kwargs=kwargs)
+        try:
+            # fork shares the boundary index with workers without pickling
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                pending = collections.deque()
+                for block in date_blocks(runs):
+                    pending.append(pool.apply_async(_flush_block_worker, (block,)))
+                    # a few dates ahead keep the workers busy without reading the whole input
+                    if len(pending) > 2 * workers:
+                        stdout.write(pending.popleft().get())
+                while pending:
+                    stdout.write(pending.popleft().get())
+        finally:
+            _worker_state.clear()
+        return
+
+    # initialize start time and date processed first
     start = datetime.datetime.now()
     flush_date = None
-
-    for line in stdin:
-        date, z, x, y, count, lat, lon, countries = line.decode().strip().split(',')
-
-        # Check if the date is within the date range
-        if not date_from <= date <= date_to:
-            continue
-        count = int(count)
-        x = int(x)
-        y = int(y)
-        z = int(z)
-        if not min_zoom <= z <= max_zoom:
-            continue
-
-        if date_precision is not None:
-            date = get_date_precision(date, date_prec, date_prec_measure)
-
+    for date, countries, run in runs:
         if flush_date is None:
             start = datetime.datetime.now()
             flush_date = date
 
-        # This assumes that input is grouped by date.
         if date != flush_date:
             sys.stderr.write('%s - %s\n' % (flush_date, datetime.datetime.now() - start))
             tiles = flush(stdout, tiles, min_count, max_count, boudaries_geom, **kwargs)
             flush_date = date
             start = datetime.datetime.now()
 
-        if z < min_subz:
-            for _x, _y, _z in get_down_tiles(x, y, z, min_subz):
-                tiles[(date, _z, _x, _y, countries)] += count
-        if z > max_subz:
-            _x, _y, _z = get_up_tile(x, y, z, max_subz)
-            tiles[(date, _z, _x, _y, countries)] += count
-        if min_subz <= z <= max_subz:
-            tiles[(date, z, x, y, countries)] += count
+        add_run(tiles, date, run, min_subz, max_subz)
 
     sys.stderr.write('%s - %s\n' % (flush_date, datetime.datetime.now() - start))
     flush(stdout, tiles, min_count, max_count, boudaries_geom, **kwargs)
@@ -263,6 +474,10 @@ if __name__ == '__main__':
     parser.add_argument('--no_latlon', action='store_true')
     parser.add_argument('--no_per_day', action='store_true')
     parser.add_argument('--no_countries', action='store_true')
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default='csv',
+                        help='csv lines or binary columnar records (see Tile_Records.py)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='aggregate dates in parallel with N processes, the output stays in date order')
 
     stdin = sys.stdin if sys.version_info.major == 2 else sys.stdin.buffer
     stdout = sys.stdout if sys.version_info.major == 2 else sys.stdout.buffer
@@ -1,15 +1,25 @@
 # Code attributions: Pavel Tyslacki
 import argparse
+import collections.abc
+import concurrent.futures
+import contextlib
 import csv
 import datetime
 import gzip
+import hashlib
+import http.client
 import io
-import itertools
 import json
 import lzma
+import multiprocessing
 import os
 import pickle
+import queue
+import resource
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import urllib.error
 import urllib.parse
@@ -17,10 +27,15 @@ import urllib.request
 
 import lxml.etree
 import mercantile
-import overpass
+import numpy as np
+import shapely
 import shapely.geometry
+import shapely.strtree
 import shapely.wkt
 
+import Tile_Records
+import Tiles
+
 
 LOGS_URL = 'http://planet.openstreetmap.org/tile_logs/'
 MIN_DATE = '0000-00-00'
@@ -39,9 +54,21 @@ RELATION_QUERY = ('[out:csv(::id, "ISO3166-1", "ISO3166-1:alpha2")];'
                   ');'
                   'out tags;')
 
+OVERPASS_URL = 'http://overpass-api.de/api/interpreter'
 PREFETCH_GEOMETRY_LINK = 'http://polygons.openstreetmap.fr/?id=%s'
 FETCH_GEOMETRY_LINK = 'http://polygons.openstreetmap.fr/get_wkt.py?id=%s&params=0'
+# seconds to wait before each retry
 MAX_FETCH_ATTEMPTS = [1, 3, 10, 30]
+FETCH_CONCURRENCY = 8
+FETCH_TIMEOUT = 60
+MAX_REDIRECTS = 5
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+FETCH_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Encoding': 'gzip',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Connection': 'keep-alive',
+}
 COUNTRIES_IDS_SKIP = (
     11980,
     1111111,
@@ -53,22 +80,62 @@ COUNTRIES_IDS_SKIP = (
 MIN_ZOOM = 0
 MAX_ZOOM = 19
 SPLIT_ZOOM = 8
+QUADTREE_MAX_ZOOM = 12
+# a region quadtree only splits the tiles on its boundary
+REGION_QUADTREE_MAX_ZOOM = 14
+BATCH_LINES = 1000000
+DECOMPRESS_BLOCK_SIZE = 16 * 1024 * 1024
+DECOMPRESS_QUEUE_SIZE = 4
+PREFETCH_DUMPS = 2
 
 MIN_INTERSECTION_AREA = 0.001
 MIN_INTERSECTION_AREA_PER_PERIMETER = 0.01
 MIN_GEOMETRY_AREA_PER_PERIMETER = 0.000005
+# max zoom of each zoom band below SPLIT_ZOOM tested on simplified geometries
+SIMPLIFY_ZOOMS = (3, 5, 7)
 
 DUMPS_CACHE_FOLDER = 'tile_logs'
 COUNTRIES_GEOM_CACHE_FOLDER = 'countries'
+# Cache files are suffixed with a hash of CACHE_VERSION, the parameters of
+# their stage and the hashes of the stages they are computed from.
+CACHE_VERSION = 1
 GEOM_CACHE = 'cache_geoms.picle'
 GROUPED_GEOM_CACHE = 'cache_grouped.picle'
 GROUPED_GEOM_WITH_EMPTY_CACHE = 'cache_grouped_with_empty.picle'
-SLICED_TO_TILES_GEOM_CACHE = 'cache_sliced_to_tiles.picle'
-TILE_CACHE = 'cache_tile.json'
+SIMPLIFIED_GEOM_CACHE = 'cache_simplified.picle'
+SLICED_TO_TILES_GEOM_CACHE = 'cache_sliced_to_tiles.bin'
+TILE_QUADTREE_CACHE = 'cache_tile_quadtree.bin'
+TILE_CACHE = 'cache_tiles.json'
+TILE_CACHE_SIZE = 1000000
+PARTITION_NAME = 'trends-%s-z%s-%s-%s-%s.%s'
+PARTITION_PART = '.part'
+PARTITION_DONE = '.done'
+
+OUTPUT_FORMATS = ('csv', 'records')
+RECORD_FIELDS = [
+    ['date', Tile_Records.DICTIONARY],
+    ['z', '<u1'],
+    ['x', '<u4'],
+    ['y', '<u4'],
+    ['count', '<i8'],
+    ['lat', '<f8'],
+    ['lon', '<f8'],
+    ['countries', Tile_Records.DICTIONARY],
+]
+
+# State shared with forked workers (copy-on-write).
+_worker_state = {}
 
 
 class Stat(object):
 
+    # file of JSON lines metrics, one per day and one per run, set by process_all
+    metrics = None
+    # counters summed by merge
+    COUNTERS = ('in_all', 'in_no_cached', 'in_child_cache', 'in_direct_cache',
+                'child_zoom_less', 'child_zoom_equal', 'filtered_bbox', 'filtered_geom',
+                'append_geom', 'exact_geom', 'cache_hits', 'cache_misses', 'cache_evictions')
+
     def __init__(self):
         self.out = sys.stderr
         self.start = datetime.datetime.now()
@@ -81,51 +148,219 @@ class Stat(object):
         self.filtered_bbox = 0
         self.filtered_geom = 0
         self.append_geom = 0
-
-    def log_stats(self, msg, cache):
-        cached_for_child = 0
-        for cached_item in cache.values():
-            if '|' not in cached_item:
-                cached_for_child += 1
+        self.exact_geom = 0
+        # tile cache lookups and evictions of the stat, not of the cache lifetime
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        # wall and CPU seconds by phase
+        self.phases = collections.OrderedDict()
+
+    def __getstate__(self):
+        # sent back by workers, the stream stays in the process
+        state = dict(self.__dict__)
+        del state['out']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, out=sys.stderr)
+
+    def merge(self, other):
+        # adds the counters and phase times of another stat, a day of the run
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for phase, (wall, cpu) in other.phases.items():
+            self.add_time(phase, wall, cpu)
+
+    def log_stats(self, msg, cache=None):
+        # cs: cache size/max size, ch: cache hits/misses/evictions
+        if cache is None:
+            cache = TileCache(0)
         self.log('%s - %s - ps: %s/%s - cc: %s/%s - zm: %s/%s - '
-                 'fl: %s/%s - ap: %s - cs: %s/%s',
+                 'fl: %s/%s - ap: %s - ex: %s - cs: %s/%s - ch: %s/%s/%s',
                  msg, datetime.datetime.now() - self.start,
                  self.in_all, self.in_no_cached,
                  self.in_child_cache, self.in_direct_cache,
                  self.child_zoom_less, self.child_zoom_equal,
                  self.filtered_bbox, self.filtered_geom,
-                 self.append_geom,
-                 cached_for_child, len(cache),
+                 self.append_geom, self.exact_geom,
+                 len(cache), cache.max_size,
+                 self.cache_hits, self.cache_misses, self.cache_evictions,
                  )
 
+    @contextlib.contextmanager
+    def timed(self, phase):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def add_time(self, phase, wall, cpu):
+        times = self.phases.setdefault(phase, [0.0, 0.0])
+        times[0] += wall
+        times[1] += cpu
+
+    def log_stages(self, msg, wall):
+        # time each phase was busy, the busiest one limits the throughput
+        self.log('%s - %.1fs - %s', msg, wall, ' - '.join(
+            '%s: %.1fs (%d%%)' % (name, busy, 100 * busy / wall if wall else 0)
+            for name, (busy, _) in self.phases.items()))
+
+    def log_metrics(self, msg, wall, cache=None):
+        if self.metrics is None:
+            return
+        if cache is None:
+            cache = TileCache(0)
+        lookups = self.cache_hits + self.cache_misses
+        self.metrics.write('%s\n' % json.dumps({
+            'time': datetime.datetime.now().isoformat(),
+            'name': msg,
+            'pid': os.getpid(),
+            'wall': wall,
+            'phases': {name: {'wall': busy, 'cpu': cpu} for name, (busy, cpu) in self.phases.items()},
+            'lines': self.in_all,
+            'lines_per_sec': self.in_all / wall if wall else 0,
+            'tiles': {'quadtree': self.in_child_cache, 'cache': self.in_direct_cache,
+                      'geometry': self.in_no_cached},
+            'geometry': {'filtered_bbox': self.filtered_bbox, 'filtered_geom': self.filtered_geom,
+                         'append_geom': self.append_geom, 'exact_geom': self.exact_geom},
+            'cache': {'size': len(cache), 'max_size': cache.max_size, 'hits': self.cache_hits,
+                      'misses': self.cache_misses, 'evictions': self.cache_evictions,
+                      'hit_ratio': self.cache_hits / lookups if lookups else 0},
+            # kilobytes on Linux
+            'peak_rss': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+        }))
+        self.metrics.flush()
+
     def log(self, msg, *args):
         self.out.write('%s\n' % (msg % args))
 
 
-def _fetch(link):
+class _Producer(threading.Thread):
+    """Iterates items in a thread and hands them over a bounded queue.
+
+    The queue gives back-pressure: the thread waits while ``size`` items are
+    not consumed yet. ``busy`` and ``busy_cpu`` are the wall and CPU time spent
+    producing items.
+    """
+
+    _DONE = object()
+
+    def __init__(self, items, size):
+        super(_Producer, self).__init__(daemon=True)
+        self.items = items
+        self.queue = queue.Queue(size)
+        self.busy = 0
+        self.busy_cpu = 0
+        self.error = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            items = iter(self.items)
+            while not self.stopped.is_set():
+                start, start_cpu = time.perf_counter(), time.thread_time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    self.busy += time.perf_counter() - start
+                    self.busy_cpu += time.thread_time() - start_cpu
+                self._put(item)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._put(self._DONE)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        if self.ident is None:
+            self.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._DONE:
+                    break
+                yield item
+        finally:
+            self.stopped.set()
+        if self.error is not None:
+            raise self.error
+
+
+class _Connections(threading.local):
+    """Keep-alive HTTP connections of the current thread, one per host."""
+
+    def __init__(self):
+        self.by_host = {}
+
+
+_connections = _Connections()
+
+
+def _request(link, data=None, redirects=MAX_REDIRECTS):
+    # GET, or POST of data as the form field 'data' like the Overpass API expects
+    parts = urllib.parse.urlsplit(link)
+    key = (parts.scheme, parts.netloc)
+    connection = _connections.by_host.get(key)
+    if connection is None:
+        connection_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                            else http.client.HTTPConnection)
+        connection = connection_class(parts.netloc, timeout=FETCH_TIMEOUT)
+        _connections.by_host[key] = connection
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    try:
+        if data is None:
+            connection.request('GET', path, headers=FETCH_HEADERS)
+        else:
+            connection.request('POST', path, urllib.parse.urlencode({'data': data}), headers=dict(
+                FETCH_HEADERS, **{'Content-Type': 'application/x-www-form-urlencoded'}))
+        response = connection.getresponse()
+        body = response.read()
+    except (http.client.HTTPException, OSError):
+        connection.close()
+        del _connections.by_host[key]
+        raise
+    location = response.getheader('Location')
+    if 300 <= response.status < 400 and location and redirects > 0:
+        # followed like urllib does, http to https moves included
+        return _request(urllib.parse.urljoin(link, location), data, redirects - 1)
+    if response.status != 200:
+        raise urllib.error.HTTPError(link, response.status, response.reason,
+                                     response.headers, None)
+    if response.getheader('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return body.decode()
+
+
+def _fetch(link, data=None):
     attempt = 0
     while True:
         try:
+            return _request(link, data)
+        except (http.client.HTTPException, OSError) as e:
+            # client errors don't go away by retrying
+            client_error = isinstance(e, urllib.error.HTTPError) and 400 <= e.code < 500
+            if client_error or attempt >= len(MAX_FETCH_ATTEMPTS):
+                raise
             time.sleep(MAX_FETCH_ATTEMPTS[attempt])
-            request = urllib.request.Request(link, headers={
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Encoding': 'gzip, deflate',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Connection': 'keep-alive',
-            })
-            return gzip.open(urllib.request.urlopen(request)).read().decode()
-        except urllib.error.HTTPError:
             attempt += 1
-            if attempt >= len(MAX_FETCH_ATTEMPTS):
-                raise
 
 
 def get_country_geom(osm_id, iso):
-    prefetch_link = FETCH_GEOMETRY_LINK % osm_id
     link = FETCH_GEOMETRY_LINK % osm_id
 
-    if not os.path.exists(COUNTRIES_GEOM_CACHE_FOLDER):
-        os.mkdir(COUNTRIES_GEOM_CACHE_FOLDER)
+    os.makedirs(COUNTRIES_GEOM_CACHE_FOLDER, exist_ok=True)
     file_name_wkt = os.path.join(COUNTRIES_GEOM_CACHE_FOLDER,
                                  '%s-%s.wkt' % (iso, osm_id))
     file_name_geojson = os.path.join(COUNTRIES_GEOM_CACHE_FOLDER,
@@ -139,8 +374,12 @@ def get_country_geom(osm_id, iso):
             response = file.read()
         geom = shapely.geometry.shape(json.loads(response))
     else:
-        _fetch(prefetch_link)
-        response = _fetch(link)
+        try:
+            response = _fetch(link)
+        except urllib.error.HTTPError:
+            # the relation page generates polygons which are not known yet
+            _fetch(PREFETCH_GEOMETRY_LINK % osm_id)
+            response = _fetch(link)
         if response.startswith('SRID=4326;'):
             response = response[len('SRID=4326;'):]
         geom = shapely.wkt.loads(response)
@@ -150,15 +389,22 @@ def get_country_geom(osm_id, iso):
     return geom
 
 
-def get_countries(rel=None, country=None, query=None):
-    countries = {}
+def get_country_geoms(relations, concurrency=FETCH_CONCURRENCY):
+    """Geometries of ``(osm_id, iso)`` relations by osm id, fetched concurrently."""
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        geoms = executor.map(lambda relation: get_country_geom(*relation), relations)
+        return dict(zip((osm_id for osm_id, _ in relations), geoms))
+
+
+def get_countries(rel=None, country=None, query=None, concurrency=FETCH_CONCURRENCY):
+    relations = []
     if query:
         pass
     elif rel:
         query = RELATION_QUERY % rel
     else:
         query = COUNTRIES_QUERY
-    response = overpass.API()._GetFromOverpass(query)
+    response = _fetch(OVERPASS_URL, query)
     reader = csv.reader(io.StringIO(response), delimiter='\t',)
     next(reader)
     for osm_id, iso3166_1, iso3166_1_alpha2 in reader:
@@ -170,13 +416,14 @@ def get_countries(rel=None, country=None, query=None):
             continue
         if country and iso != country:
             continue
-        if (osm_id, iso) in countries:
+        if (osm_id, iso) in relations:
             continue
         Stat().log('%s-%s', iso, osm_id)
-        geom = get_country_geom(osm_id, iso)
-        countries[osm_id] = (iso, geom, geom.bounds)
+        relations.append((osm_id, iso))
 
-    return countries
+    geoms = get_country_geoms(relations, concurrency)
+    return {osm_id: (iso, geoms[osm_id], geoms[osm_id].bounds)
+            for osm_id, iso in relations}
 
 
 def _clear_xml_element(element):
@@ -208,141 +455,572 @@ def get_tile_usage_dump_links(date_from=None, date_to=None):
     return sorted(links)
 
 
-def get_tile_usage_dump(link):
+def _download(link, file_name):
+    """Streams link to file_name, resuming a partial ``.part`` download."""
+    part_name = file_name + '.part'
+    attempt = 0
+    while True:
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+        request = urllib.request.Request(link, headers={
+            'Range': 'bytes=%s-' % offset} if offset else {})
+        try:
+            with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+                if response.status == 206:
+                    size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                else:
+                    # the server ignored the range, start over
+                    offset = 0
+                    size = int(response.headers['Content-Length'])
+                with open(part_name, 'ab' if offset else 'wb') as file:
+                    shutil.copyfileobj(response, file, DOWNLOAD_CHUNK_SIZE)
+            if os.path.getsize(part_name) != size:
+                raise IOError('incomplete download of %s: %s of %s bytes' % (
+                    link, os.path.getsize(part_name), size))
+            os.replace(part_name, file_name)
+            return
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            # the part is bigger than the file, it can't be resumed
+            os.remove(part_name)
+        except (http.client.HTTPException, OSError):
+            if attempt >= len(MAX_FETCH_ATTEMPTS):
+                raise
+            time.sleep(MAX_FETCH_ATTEMPTS[attempt])
+            attempt += 1
+
+
+def cache_tile_usage_dump(link):
+    os.makedirs(DUMPS_CACHE_FOLDER, exist_ok=True)
     dump_cache = os.path.join(DUMPS_CACHE_FOLDER,
                               link[-len('tiles-YYYY-MM-DD.txt.xz'):])
-    if os.path.exists(dump_cache):
-        return io.BytesIO(open(dump_cache, 'rb').read())
-    return urllib.request.urlopen(link)
+    if not os.path.exists(dump_cache):
+        _download(link, dump_cache)
+    return dump_cache
 
 
-def detect_country(b, x, y, z, part_zoom, tiled_countries, all_countries, stat):
-    twest, tsouth, teast, tnorth = b
-    tgeom = shapely.geometry.box(twest, tsouth, teast, tnorth)
-    result = None
+def prune_tile_usage_dumps(date_from):
+    """Deletes the cached dumps of the days before date_from, partial
+    downloads included."""
+    if not date_from or not os.path.isdir(DUMPS_CACHE_FOLDER):
+        return
+    pruned = [file_name for file_name in os.listdir(DUMPS_CACHE_FOLDER)
+              if file_name.startswith('tiles-')
+              and file_name[len('tiles-'):len('tiles-YYYY-MM-DD')] < date_from]
+    for file_name in pruned:
+        os.remove(os.path.join(DUMPS_CACHE_FOLDER, file_name))
+    Stat().log('tile logs: %s files pruned', len(pruned))
 
-    if z < part_zoom:
-        countries = all_countries
-    else:
-        delta_zooms = z - part_zoom
-        delta = 2 ** delta_zooms
-        px = x // delta
-        py = y // delta
-        countries = tiled_countries['%s/%s/%s' % (part_zoom, px, py)]
-
-    for iso, boundary, outer_box in countries:
-        owest, osouth, oeast, onorth = outer_box
-        if not (twest <= oeast and teast >= owest and
-                tnorth >= osouth and tsouth <= onorth):
-            stat.filtered_bbox += 1
-            continue
-        if not boundary.intersects(tgeom):
-            stat.filtered_geom += 1
-            continue
-        if result is None:
-            result = {iso}
-        else:
-            result.add(iso)
-        stat.append_geom += 1
-    return result and '|'.join(sorted(result)) or '??'
-
-
-def detect_country_with_cache(k, b, x, y, z,
-                              part_zoom, tiled_countries, all_countries,
-                              min_cache_zoom, cache, stat):
-    stat.in_all += 1
-    if k in cache:
-        stat.in_direct_cache += 1
-        return cache[k]
-
-    for pz in range(min_cache_zoom, z):
-        delta_zooms = z - pz
-        delta = 2 ** delta_zooms
-        px = x // delta
-        py = y // delta
-        ck = '%s/%s/%s' % (pz, px, py)
-        potential_cc = False
-        if ck in cache:
-            country = cache[ck]
-            potential_cc = True
-        else:
-            stat.in_no_cached += 1
-            country = detect_country(
-                b, px, py, pz, part_zoom, tiled_countries, all_countries, stat)
-            cache[k] = country
-
-        if pz < z and '|' not in country:
-            stat.child_zoom_less += 1
-            if potential_cc:
-                stat.in_child_cache += 1
-            return country
-
-    stat.in_no_cached += 1
-    stat.child_zoom_equal += 1
-    country = detect_country(
-        b, x, y, z, part_zoom, tiled_countries, all_countries, stat)
-    cache[k] = country
-    return country
-
-
-def process_item(out, min_cache_zoom, cache, link,
-                 part_zoom, tiled_countries, all_countries,
-                 min_zoom, max_zoom, skip_empty_tiles):
-    stat = Stat()
-    date = get_date_from_link(link)
 
-    for line in lzma.LZMAFile(get_tile_usage_dump(link)):
-        path, count = line.decode().strip().split()
-        z, x, y = path.split('/')
+def get_tile_usage_dump(link):
+    return open(cache_tile_usage_dump(link), 'rb')
 
-        x = int(x)
-        y = int(y)
-        z = int(z)
 
-        if min_zoom is not None and z < min_zoom:
-            continue
-        if max_zoom is not None and z > max_zoom:
-            continue
+def _cache_tile_usage_dumps(links):
+    for link in links:
+        cache_tile_usage_dump(link)
+        yield link
 
-        twest, tsouth, teast, tnorth = b = mercantile.bounds(x, y, z)
-        country = detect_country_with_cache(
-            path, b, x, y, z, part_zoom, tiled_countries, all_countries,
-            min_cache_zoom, cache, stat)
 
-        if skip_empty_tiles and country == '??':
-            continue
+def prefetch_tile_usage_dumps(links, ahead=PREFETCH_DUMPS):
+    """Yields links in order, downloading the next ``ahead`` dumps meanwhile."""
+    return _Producer(_cache_tile_usage_dumps(links), ahead)
 
-        lat = tnorth + (tnorth - tsouth) / 2
-        lon = twest + (teast - twest) / 2
 
-        out.write(('%s,%s,%s,%s,%s,%s,%s,%s\n' % (
-            date, z, x, y, count, lat, lon, country)).encode())
-    stat.log_stats(date, cache)
+class CountryIndex(object):
+    """STRtree over prepared country geometries of one zoom 8 slice or the world.
 
+    With ``approximations``, the inner and outer geometries of
+    ``simplify_geoms``, tiles are tested on them first and on the exact
+    geometries only if they intersect the outer but not the inner one.
+    """
+
+    def __init__(self, countries, approximations=None):
+        self.countries = countries
+        self.approximations = approximations
+        self.isos = tuple(iso for iso, _, _ in countries)
+        self.geoms = np.array([boundary for _, boundary, _ in countries], dtype=object)
+        shapely.prepare(self.geoms)
+        self.tree = shapely.strtree.STRtree(self.geoms)
+        if approximations is not None:
+            self.inner, self.outer = approximations
+            shapely.prepare(self.inner)
+            shapely.prepare(self.outer)
+
+    def query_bulk(self, tgeoms, stat):
+        # one tree query and one predicate call for all tiles
+        tile_idx, country_idx = self.tree.query(tgeoms)
+        if self.approximations is None:
+            hits = shapely.intersects(self.geoms[country_idx], tgeoms[tile_idx])
+        else:
+            hits = shapely.intersects(self.outer[country_idx], tgeoms[tile_idx])
+            exact = hits.copy()
+            exact[hits] = ~shapely.intersects(self.inner[country_idx[hits]], tgeoms[tile_idx[hits]])
+            hits[exact] = shapely.intersects(self.geoms[country_idx[exact]], tgeoms[tile_idx[exact]])
+            stat.exact_geom += int(exact.sum())
+        hits_count = int(hits.sum())
+        stat.filtered_bbox += len(tgeoms) * len(self.countries) - len(tile_idx)
+        stat.filtered_geom += len(hits) - hits_count
+        stat.append_geom += hits_count
+
+        result = [None] * len(tgeoms)
+        for t, c in zip(tile_idx[hits].tolist(), country_idx[hits].tolist()):
+            if result[t] is None:
+                result[t] = {self.isos[c]}
+            else:
+                result[t].add(self.isos[c])
+        return [isos and '|'.join(sorted(isos)) or '??' for isos in result]
+
+
+# Indexes are built lazily, once per countries tuple and approximations, and
+# kept for the process.
+_country_indexes = {}
+
+
+def get_country_index(countries, approximations=None):
+    key = (id(countries), id(approximations))
+    if (key not in _country_indexes or _country_indexes[key].countries is not countries or
+            _country_indexes[key].approximations is not approximations):
+        _country_indexes[key] = CountryIndex(countries, approximations)
+    return _country_indexes[key]
+
+
+def detect_countries(zs, xs, ys, part_zoom, tiled_countries, all_countries, stat,
+                     simplified_countries=None):
+    countries = [None] * len(zs)
+    if not len(zs):
+        return countries
+    west, south, east, north = Tiles.tiles_bounds(zs, xs, ys)
+    tgeoms = shapely.box(west, south, east, north)
+
+    # group tiles by the zoom 8 slice they fall in, low zooms use all countries,
+    # simplified for the zoom band if given
+    shift = np.maximum(zs - part_zoom, 0)
+    slices = np.where(zs < part_zoom, -1 - zs, ((xs >> shift) << part_zoom) | (ys >> shift))
+    order = np.argsort(slices, kind='stable')
+    slice_keys, starts = np.unique(slices[order], return_index=True)
+    for slice_key, idx in zip(slice_keys.tolist(), np.split(order, starts[1:])):
+        approximations = None
+        if slice_key < 0:
+            slice_countries = all_countries
+            bands = [zoom for zoom in simplified_countries or () if zoom >= -1 - slice_key]
+            if bands:
+                approximations = simplified_countries[min(bands)]
+        else:
+            slice_countries = tiled_countries['%s/%s/%s' % (
+                part_zoom, slice_key >> part_zoom, slice_key & ((1 << part_zoom) - 1))]
+        slice_result = get_country_index(slice_countries, approximations).query_bulk(
+            tgeoms[idx], stat)
+        for i, country in zip(idx.tolist(), slice_result):
+            countries[i] = country
+    return countries
 
-def create_cache(part_zoom, countries, splited_countries, min_cache_zoom):
-    stat = Stat()
 
-    cache = {}
-    if min_cache_zoom:
-        stat.log_stats('cache (%s)' % min_cache_zoom, cache)
-        return min_cache_zoom, cache
-
-    min_cache_zoom = MIN_ZOOM
-    for z in range(MAX_ZOOM + 1):
-        for x in range(2 ** z):
-            for y in range(2 ** z):
-                k = '%s/%s/%s' % (z, x, y)
-                b = mercantile.bounds(x, y, z)
-                country = detect_country_with_cache(
-                    k, b, x, y, z, part_zoom, countries, splited_countries,
-                    z, cache, stat)
-                if '|' not in country:
-                    min_cache_zoom = z
-        if min_cache_zoom > 0:
+class TileQuadtree(object):
+    """Countries of tiles as a quadtree, memory mapped from TILE_QUADTREE_CACHE.
+
+    Nodes are stored level by level: ``codes`` holds the index of the node
+    country in ``names`` and ``children`` the index of the first of the four
+    children (ordered by ``(x & 1) << 1 | y & 1``) or -1 for leaves. Only
+    tiles with several countries have children, down to ``max_zoom``.
+
+    File layout: a header (magic, max zoom, names size, nodes count), the
+    country names joined by newlines and padded to 8 bytes, the int32
+    children array padded to 8 bytes, then the uint16 codes array.
+    """
+
+    MAGIC = b'TLQ1'
+    HEADER = np.dtype([('magic', 'S4'), ('max_zoom', '<u4'),
+                       ('names_size', '<u4'), ('nodes_size', '<u4')])
+
+    def __init__(self, max_zoom, names, children, codes):
+        self.max_zoom = max_zoom
+        self.names = names
+        self.children = children
+        self.codes = codes
+        self.ambiguous = np.array(['|' in name for name in names], dtype=bool)
+
+    @classmethod
+    def load(cls, file):
+        data = np.memmap(file, dtype=np.uint8, mode='r')
+        header = data[:cls.HEADER.itemsize].view(cls.HEADER)[0]
+        if header['magic'] != cls.MAGIC:
+            raise ValueError('not a tile quadtree file')
+        offset = cls.HEADER.itemsize
+        names = data[offset:offset + header['names_size']].tobytes().decode().split('\n')
+        offset += _padded(int(header['names_size']))
+        nodes_size = int(header['nodes_size'])
+        children = data[offset:offset + nodes_size * 4].view('<i4')
+        offset += _padded(nodes_size * 4)
+        codes = data[offset:offset + nodes_size * 2].view('<u2')
+        return cls(int(header['max_zoom']), names, children, codes)
+
+    @classmethod
+    def dump(cls, tile_quadtree, file):
+        names = '\n'.join(tile_quadtree.names).encode()
+        header = np.array([(cls.MAGIC, tile_quadtree.max_zoom, len(names),
+                            len(tile_quadtree))], dtype=cls.HEADER)
+        file.write(header.tobytes())
+        file.write(names.ljust(_padded(len(names)), b'\0'))
+        children = np.ascontiguousarray(tile_quadtree.children, dtype='<i4').tobytes()
+        file.write(children.ljust(_padded(len(children)), b'\0'))
+        file.write(np.ascontiguousarray(tile_quadtree.codes, dtype='<u2').tobytes())
+
+    def __len__(self):
+        return len(self.codes)
+
+    def lookup(self, zs, xs, ys):
+        """Countries of tiles resolved by the quadtree, None for unresolved ones.
+
+        A tile resolves at its own node, or at a leaf above it with a single
+        country. Each tile walks at most ``max_zoom`` levels.
+        """
+        countries = [None] * len(zs)
+        idx = np.arange(len(zs))
+        node = np.zeros(len(zs), dtype=np.int64)
+        for depth in range(self.max_zoom + 1):
+            first_child = self.children[node]
+            codes = self.codes[node]
+            done = (zs[idx] == depth) | ((first_child < 0) & ~self.ambiguous[codes])
+            for i, code in zip(idx[done].tolist(), codes[done].tolist()):
+                countries[i] = self.names[code]
+
+            descend = ~done & (first_child >= 0)
+            idx, first_child = idx[descend], first_child[descend]
+            if not len(idx):
+                break
+            shift = zs[idx] - depth - 1
+            node = first_child + ((((xs[idx] >> shift) & 1) << 1) | ((ys[idx] >> shift) & 1))
+        return countries
+
+
+def _padded(size):
+    return (size + 7) // 8 * 8
+
+
+class TiledGeoms(collections.abc.Mapping):
+    """Country parts of the ``z/x/y`` tiles of one zoom, memory mapped from
+    SLICED_TO_TILES_GEOM_CACHE.
+
+    Geometries are stored as WKB and a tile is decoded on first access only,
+    the decoded parts are kept so each tile maps to the same tuple.
+
+    File layout: a header (magic, zoom, names size, parts count), the country
+    names joined by newlines and padded to 8 bytes, the int64 index of the
+    first part of every ``x << zoom | y`` tile plus the end, the uint16 name
+    codes of the parts padded to 8 bytes, the int64 offsets of the parts WKB
+    plus the end, then the WKB of all parts.
+    """
+
+    MAGIC = b'TLG1'
+    HEADER = np.dtype([('magic', 'S4'), ('zoom', '<u4'),
+                       ('names_size', '<u4'), ('parts_size', '<u4')])
+
+    def __init__(self, zoom, names, starts, codes, offsets, wkb):
+        self.zoom = zoom
+        self.names = names
+        self.starts = starts
+        self.codes = codes
+        self.offsets = offsets
+        self.wkb = wkb
+        self._tiles = {}
+
+    @classmethod
+    def load(cls, file):
+        data = np.memmap(file, dtype=np.uint8, mode='r')
+        header = data[:cls.HEADER.itemsize].view(cls.HEADER)[0]
+        if header['magic'] != cls.MAGIC:
+            raise ValueError('not a tiled geometries file')
+        zoom = int(header['zoom'])
+        parts_size = int(header['parts_size'])
+        offset = cls.HEADER.itemsize
+        names = data[offset:offset + header['names_size']].tobytes().decode().split('\n')
+        offset += _padded(int(header['names_size']))
+        starts = data[offset:offset + (4 ** zoom + 1) * 8].view('<i8')
+        offset += (4 ** zoom + 1) * 8
+        codes = data[offset:offset + parts_size * 2].view('<u2')
+        offset += _padded(parts_size * 2)
+        offsets = data[offset:offset + (parts_size + 1) * 8].view('<i8')
+        offset += (parts_size + 1) * 8
+        return cls(zoom, names, starts, codes, offsets, data[offset:])
+
+    @classmethod
+    def dump(cls, tiles, file):
+        keys = sorted(tuple(int(part) for part in key.split('/')) for key in tiles)
+        zoom = keys[0][0]
+        names = {}
+        counts = np.zeros(4 ** zoom, dtype=np.int64)
+        codes = []
+        geoms = []
+        for z, x, y in keys:
+            parts = tiles['%s/%s/%s' % (z, x, y)]
+            counts[x << zoom | y] = len(parts)
+            for iso, geom, _ in parts:
+                codes.append(names.setdefault(iso, len(names)))
+                geoms.append(geom)
+        wkbs = shapely.to_wkb(np.array(geoms, dtype=object)).tolist()
+
+        names = '\n'.join(sorted(names, key=names.get)).encode()
+        header = np.array([(cls.MAGIC, zoom, len(names), len(codes))], dtype=cls.HEADER)
+        file.write(header.tobytes())
+        file.write(names.ljust(_padded(len(names)), b'\0'))
+        file.write(np.concatenate([[0], np.cumsum(counts)]).astype('<i8').tobytes())
+        codes = np.array(codes, dtype='<u2').tobytes()
+        file.write(codes.ljust(_padded(len(codes)), b'\0'))
+        sizes = np.array([len(wkb) for wkb in wkbs], dtype=np.int64)
+        file.write(np.concatenate([[0], np.cumsum(sizes)]).astype('<i8').tobytes())
+        for wkb in wkbs:
+            file.write(wkb)
+
+    def __len__(self):
+        return 4 ** self.zoom
+
+    def __iter__(self):
+        for x in range(2 ** self.zoom):
+            for y in range(2 ** self.zoom):
+                yield '%s/%s/%s' % (self.zoom, x, y)
+
+    def __getitem__(self, key):
+        z, x, y = (int(part) for part in key.split('/'))
+        if z != self.zoom or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            raise KeyError(key)
+        tile = x << z | y
+        if tile not in self._tiles:
+            start, end = self.starts[tile], self.starts[tile + 1]
+            offsets = self.offsets[start:end + 1].tolist()
+            geoms = shapely.from_wkb(np.array(
+                [self.wkb[offsets[i]:offsets[i + 1]].tobytes() for i in range(end - start)],
+                dtype=object))
+            self._tiles[tile] = tuple((self.names[code], geom, geom.bounds)
+                                      for code, geom in zip(self.codes[start:end].tolist(), geoms))
+        return self._tiles[tile]
+
+
+def create_tile_quadtree(part_zoom, tiled_countries, all_countries, max_zoom,
+                         simplified_countries=None):
+    stat = Stat()
+    names = {}
+    children = []
+    codes = []
+
+    # breadth first descent, every level is classified in bulk
+    zs = xs = ys = np.zeros(1, dtype=np.int64)
+    offset = 0
+    for z in range(max_zoom + 1):
+        countries = []
+        for start in range(0, len(zs), BATCH_LINES):
+            end = start + BATCH_LINES
+            countries += detect_countries(zs[start:end], xs[start:end], ys[start:end],
+                                          part_zoom, tiled_countries, all_countries, stat,
+                                          simplified_countries)
+        level_codes = np.array([names.setdefault(country, len(names))
+                                for country in countries], dtype=np.uint16)
+        split = np.array(['|' in country for country in countries], dtype=bool)
+        if z == max_zoom:
+            split[:] = False
+        offset += len(zs)
+        level_children = np.full(len(zs), -1, dtype=np.int32)
+        level_children[split] = offset + 4 * np.arange(split.sum())
+        children.append(level_children)
+        codes.append(level_codes)
+        stat.log('quadtree zoom %s: %s nodes, %s split', z, len(zs), split.sum())
+
+        parents = split.sum()
+        if not parents:
+            break
+        xs = np.repeat(xs[split] * 2, 4) + np.tile([0, 0, 1, 1], parents)
+        ys = np.repeat(ys[split] * 2, 4) + np.tile([0, 1, 0, 1], parents)
+        zs = np.full(len(xs), z + 1, dtype=np.int64)
+
+    stat.log_stats('quadtree (%s) - %s countries' % (max_zoom, len(names)))
+    return TileQuadtree(max_zoom, [name for name, _ in sorted(names.items(), key=lambda i: i[1])],
+                        np.concatenate(children), np.concatenate(codes))
+
+
+class TileCache(object):
+    """Countries of the tiles the quadtree can't resolve by packed tile key,
+    the least recently used ones evicted beyond ``max_size`` entries.
+
+    Dumped as JSON lists of keys and countries, least recently used first.
+    """
+
+    def __init__(self, max_size=TILE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # entries set since tracking started, see _process_item_worker
+        self.added = None
+
+    @classmethod
+    def load(cls, file, max_size=TILE_CACHE_SIZE):
+        cache = cls(max_size)
+        data = json.load(file)
+        # the most recently used entries, none without a size
+        first = max(len(data['keys']) - max_size, 0)
+        for key, country in zip(data['keys'][first:], data['countries'][first:]):
+            cache.entries[key] = country
+        return cache
+
+    @classmethod
+    def dump(cls, cache, file):
+        json.dump({'keys': list(cache.entries), 'countries': list(cache.entries.values())}, file)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        country = self.entries.get(key)
+        if country is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return country
+
+    def __setitem__(self, key, country):
+        self.entries[key] = country
+        self.entries.move_to_end(key)
+        if self.added is not None:
+            self.added[key] = country
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+def detect_countries_with_cache(zs, xs, ys, part_zoom, tiled_countries, all_countries,
+                                tile_quadtree, cache, stat):
+    # classifies every distinct tile once, unknown tiles in bulk
+    keys, inverse = np.unique((zs << 40) | (xs << 20) | ys, return_inverse=True)
+    uzs, uxs, uys = keys >> 40, (keys >> 20) & 0xfffff, keys & 0xfffff
+    if tile_quadtree is not None:
+        countries = tile_quadtree.lookup(uzs, uxs, uys)
+    else:
+        countries = [None] * len(keys)
+    in_quadtree = len(countries) - countries.count(None)
+
+    unresolved = [i for i, country in enumerate(countries) if country is None]
+    for i, key in zip(unresolved, keys[unresolved].tolist()):
+        countries[i] = cache.get(key)
+    missed = np.array([i for i in unresolved if countries[i] is None], dtype=np.int64)
+    detected = detect_countries(uzs[missed], uxs[missed], uys[missed],
+                                part_zoom, tiled_countries, all_countries, stat)
+    for i, key, country in zip(missed.tolist(), keys[missed].tolist(), detected):
+        countries[i] = cache[key] = country
+
+    stat.in_all += len(zs)
+    stat.in_child_cache += in_quadtree
+    stat.child_zoom_less += in_quadtree
+    stat.in_no_cached += len(missed)
+    stat.child_zoom_equal += len(missed)
+    stat.in_direct_cache += len(keys) - in_quadtree - len(missed)
+    return [countries[i] for i in inverse.reshape(-1).tolist()]
+
+
+def parse_tile_log_block(block, min_zoom=None, max_zoom=None):
+    """Parses whole ``z/x/y count`` lines into z, x, y and count int64 arrays.
+
+    The numbers of the whole block are decoded in one C pass of
+    ``np.fromstring``, lines outside the zoom range are dropped from the
+    arrays, no per line object is ever created.
+    """
+    numbers = np.fromstring(block.replace(b'/', b' '), dtype=np.int64, sep=' ')
+    lines = block.count(b'\n')
+    if block and not block.endswith(b'\n'):
+        lines += 1
+    if len(numbers) != lines * 4 or block.count(b'/') != lines * 2:
+        raise ValueError('malformed tile log block, %s numbers in %s lines' % (
+            len(numbers), lines))
+
+    zs, xs, ys, counts = numbers.reshape(-1, 4).T
+    if min_zoom is not None or max_zoom is not None:
+        selected = np.ones(len(zs), dtype=bool)
+        if min_zoom is not None:
+            selected &= zs >= min_zoom
+        if max_zoom is not None:
+            selected &= zs <= max_zoom
+        zs, xs, ys, counts = zs[selected], xs[selected], ys[selected], counts[selected]
+    return zs, xs, ys, counts
+
+
+def _read_blocks(file, size):
+    # blocks of whole lines
+    rest = b''
+    while True:
+        block = file.read(size)
+        if not block:
             break
-    stat.log_stats('cache (%s)' % min_cache_zoom, cache)
-    return min_cache_zoom, cache
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+    if rest:
+        yield rest
+
+
+def _write_rows(out, output_format, date, zs, xs, ys, counts, lats, lons, countries,
+                skip_empty_tiles):
+    if output_format == 'records':
+        if skip_empty_tiles:
+            selected = np.array([country != '??' for country in countries], dtype=bool)
+            zs, xs, ys, counts = zs[selected], xs[selected], ys[selected], counts[selected]
+            lats, lons = lats[selected], lons[selected]
+            countries = [country for country in countries if country != '??']
+        Tile_Records.write_chunk(out, RECORD_FIELDS, {
+            'date': date, 'z': zs, 'x': xs, 'y': ys, 'count': counts,
+            'lat': lats, 'lon': lons, 'countries': countries})
+        return
+
+    rows = []
+    for row in zip(zs.tolist(), xs.tolist(), ys.tolist(), counts.tolist(),
+                   lats.tolist(), lons.tolist(), countries):
+        if skip_empty_tiles and row[-1] == '??':
+            continue
+        rows.append('%s,%s,%s,%s,%s,%s,%s,%s\n' % ((date,) + row))
+    out.write(''.join(rows).encode())
+
+
+def process_item(out, tile_quadtree, cache, link,
+                 part_zoom, tiled_countries, all_countries,
+                 min_zoom, max_zoom, skip_empty_tiles, output_format='csv'):
+    # returns the stat of the day
+    stat = Stat()
+    date = get_date_from_link(link)
+    start = time.perf_counter()
+    hits, misses, evictions = cache.hits, cache.misses, cache.evictions
+
+    with stat.timed('download'):
+        dump = get_tile_usage_dump(link)
+    with dump:
+        # LZMA releases the GIL, blocks are decompressed while the previous
+        # ones are classified
+        blocks = _Producer(_read_blocks(lzma.LZMAFile(dump), DECOMPRESS_BLOCK_SIZE),
+                           DECOMPRESS_QUEUE_SIZE)
+        for block in blocks:
+            with stat.timed('parse'):
+                zs, xs, ys, counts = parse_tile_log_block(block, min_zoom, max_zoom)
+
+            with stat.timed('classify'):
+                countries = detect_countries_with_cache(
+                    zs, xs, ys, part_zoom, tiled_countries, all_countries,
+                    tile_quadtree, cache, stat)
+
+                lats, lons = Tiles.tiles_centers(zs, xs, ys)
+
+            with stat.timed('write'):
+                _write_rows(out, output_format, date, zs, xs, ys, counts, lats, lons, countries,
+                            skip_empty_tiles)
+    stat.add_time('decompress', blocks.busy, blocks.busy_cpu)
+    stat.cache_hits = cache.hits - hits
+    stat.cache_misses = cache.misses - misses
+    stat.cache_evictions = cache.evictions - evictions
+    wall = time.perf_counter() - start
+    stat.log_stats(date, cache)
+    stat.log_stages(date, wall)
+    stat.log_metrics(date, wall, cache)
+    return stat
 
 
 def add_no_country_items(grouped_countries, tiled_countries):
@@ -362,19 +1040,45 @@ def add_no_country_items(grouped_countries, tiled_countries):
                                      for geom in no_country_geoms.values())
 
 
-def slice_geoms_to_tiles(grouped_countries):
+def simplify_geoms(countries, zooms=SIMPLIFY_ZOOMS):
+    """Inner and outer approximations of the countries geometries for zoom bands.
+
+    Geometries are simplified with a tolerance of a pixel of the tiles of the
+    band max zoom. The exact boundaries stay within the tolerance of the
+    simplified ones, so buffering them by twice the tolerance inwards and
+    outwards gives geometries inside and around the exact ones.
+    """
+    geoms = np.array([geom for _, geom, _ in countries], dtype=object)
+    simplified_countries = {}
+    for zoom in zooms:
+        start = datetime.datetime.utcnow()
+        tolerance = 360.0 / 2 ** zoom / 256
+        simplified = shapely.simplify(geoms, tolerance, preserve_topology=True)
+        simplified_countries[zoom] = (shapely.buffer(simplified, -2 * tolerance),
+                                      shapely.buffer(simplified, 2 * tolerance))
+        Stat().log('simplified for zoom %s in %s', zoom, datetime.datetime.utcnow() - start)
+    return simplified_countries
+
+
+def _slice_geoms_to_column(x):
+    grouped_countries = _worker_state['grouped_countries']
+    index = get_country_index(grouped_countries)
     tiles = {}
     z = SPLIT_ZOOM
-    for x in range(2 ** z):
-        for y in range(2 ** z):
-            start = datetime.datetime.utcnow()
-            twest, tsouth, teast, tnorth = mercantile.bounds(x, y, z)
-            bound = shapely.geometry.box(twest, tsouth, teast, tnorth)
+    for y in range(2 ** z):
+        start = datetime.datetime.utcnow()
+        twest, tsouth, teast, tnorth = mercantile.bounds(x, y, z)
+        bound = shapely.geometry.box(twest, tsouth, teast, tnorth)
+        candidates = np.sort(index.tree.query(bound, predicate='intersects')).tolist()
+        if not candidates:
+            parts = [('??', bound)]
+        elif len(candidates) == 1 and index.geoms[candidates[0]].contains(bound):
+            parts = [(grouped_countries[candidates[0]][0], bound)]
+        else:
             no_country_geom = shapely.geometry.box(twest, tsouth, teast, tnorth)
             parts = []
-            for iso, geom, _ in grouped_countries:
-                if not bound.intersects(geom):
-                    continue
+            for i in candidates:
+                iso, geom, _ = grouped_countries[i]
                 geom_part = bound.intersection(geom)
                 no_country_geom = no_country_geom.difference(geom_part)
                 parts.append((iso, geom_part))
@@ -382,35 +1086,53 @@ def slice_geoms_to_tiles(grouped_countries):
             if not no_country_geom.buffer(0).is_empty:
                 parts.append(('??', no_country_geom))
 
-            time_spent = (datetime.datetime.utcnow() - start).total_seconds()
-            Stat().log('polygons in %s/%s/%s: %s - %s%s', z, x, y,
-                       len(parts), '|'.join(iso for iso, _ in parts),
-                       '' if time_spent < 1 else (' (%s sec.)' % time_spent))
-            tiles['%s/%s/%s' % (z, x, y)] = tuple((iso, geom, geom.bounds)
-                                                  for iso, geom in parts)
+        time_spent = (datetime.datetime.utcnow() - start).total_seconds()
+        Stat().log('polygons in %s/%s/%s: %s - %s%s', z, x, y,
+                   len(parts), '|'.join(iso for iso, _ in parts),
+                   '' if time_spent < 1 else (' (%s sec.)' % time_spent))
+        tiles['%s/%s/%s' % (z, x, y)] = tuple((iso, geom, geom.bounds)
+                                              for iso, geom in parts)
     return tiles
 
 
-def group_geoms(countries):
-    grouped_countries = {}
-    for iso, geom, bbox in countries.values():
-        geom = geom.buffer(0)
-        if iso not in grouped_countries:
-            grouped_countries[iso] = geom
+def slice_geoms_to_tiles(grouped_countries, workers=None):
+    tiles = {}
+    columns = range(2 ** SPLIT_ZOOM)
+    # the index is built before forking so workers share it
+    get_country_index(grouped_countries)
+    _worker_state.update(grouped_countries=grouped_countries)
+    try:
+        if workers and workers > 1:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for column_tiles in pool.imap(_slice_geoms_to_column, columns):
+                    tiles.update(column_tiles)
         else:
-            grouped_countries[iso] = grouped_countries[iso].union(geom)
+            for x in columns:
+                tiles.update(_slice_geoms_to_column(x))
+    finally:
+        _worker_state.clear()
+    return tiles
+
 
+def group_geoms(countries):
+    start = datetime.datetime.utcnow()
+    iso_geoms = {}
+    for iso, geom, bbox in countries.values():
+        iso_geoms.setdefault(iso, []).append(geom.buffer(0))
+    grouped_countries = {iso: geoms[0] if len(geoms) == 1 else shapely.union_all(geoms)
+                         for iso, geoms in iso_geoms.items()}
+    Stat().log('grouped by iso in %s', datetime.datetime.utcnow() - start)
+
+    start = datetime.datetime.utcnow()
+    isos = list(grouped_countries)
+    geoms = np.array([grouped_countries[iso] for iso in isos], dtype=object)
+    tree = shapely.strtree.STRtree(geoms)
     overlapped = []
-    for iso_geom_1, iso_geom_2 in itertools.combinations(grouped_countries.items(), 2):
-        iso_1, geom_1 = iso_geom_1
-        iso_2, geom_2 = iso_geom_2
-        west_1, south_1, east_1, north_1 = geom_1.bounds
-        west_2, south_2, east_2, north_2 = geom_2.bounds
-        if not (west_1 <= east_2 and east_1 >= west_2 and
-                north_1 >= south_2 and south_1 <= north_2):
-            continue
-        if not geom_1.intersects(geom_2):
+    for i, j in sorted(zip(*tree.query(geoms, predicate='intersects').tolist())):
+        if i >= j:
             continue
+        iso_1, geom_1 = isos[i], geoms[i]
+        iso_2, geom_2 = isos[j], geoms[j]
         intersection = geom_1.intersection(geom_2)
         if not intersection.area or not intersection.length:
             continue
@@ -420,7 +1142,9 @@ def group_geoms(countries):
             continue
         overlapped.append([iso_1, iso_2])
         Stat().log('intersects %s and %s', iso_1, iso_2)
+    Stat().log('overlaps found in %s', datetime.datetime.utcnow() - start)
 
+    start = datetime.datetime.utcnow()
     # only 2 geometries overlapping processed,
     # 3 and more ignored because not found for enough big intersection
     grouped_countries_update = {}
@@ -441,53 +1165,328 @@ def group_geoms(countries):
             grouped_countries_update[iso] = geom
 
     grouped_countries.update(grouped_countries_update)
+    Stat().log('overlaps split in %s', datetime.datetime.utcnow() - start)
 
     return tuple((iso, geom, geom.bounds)
                  for iso, geom in grouped_countries.items()
                  if geom and not geom.is_empty)
 
 
-def _cached_op(op, *args, title=None, cache=None, loader=pickle, block=True):
-    if cache and os.path.exists(cache):
-        with open(cache, 'rb' if block else 'r') as cache_file:
-            result = loader.load(cache_file)
-    else:
-        result = op(*args)
-        if cache:
-            with open(cache, 'wb' if block else 'w') as cache_file:
-                loader.dump(result, cache_file)
-    if title:
-        Stat().log('%s: %s', title, len(result))
-    return result
+class _CachedOp(object):
+    """Result of ``op(*args)``, loaded from or stored to a cache file on first
+    access to ``result``.
 
+    The cache file name is suffixed with a hash of the stage parameters and
+    the keys of the cached ops in ``args``, so a cache is not reused once
+    anything it is computed from changes. Cached ops in ``args`` are only
+    loaded if the result has to be computed.
+    """
 
-def process_all(out, date_from=None, date_to=None,
-                min_zoom=None, max_zoom=None,
-                rel=None, country=None, min_cache_zoom=None):
-    use_cache = not rel and not country
-    full_countries = _cached_op(
+    _MISSING = object()
+
+    def __init__(self, op, *args, title=None, cache=None, loader=pickle, params=()):
+        self.op = op
+        self.args = args
+        self.title = title
+        self.loader = loader
+        inputs = [arg.key for arg in args if isinstance(arg, _CachedOp)]
+        self.key = hashlib.sha1(json.dumps(
+            [CACHE_VERSION, op.__name__, params, inputs], default=repr).encode()).hexdigest()
+        if cache:
+            name, ext = os.path.splitext(cache)
+            cache = '%s.%s%s' % (name, self.key[:16], ext)
+        self.cache = cache
+        self._result = self._MISSING
+
+    @property
+    def result(self):
+        if self._result is self._MISSING:
+            self._result = self._load_or_run()
+            if self.title:
+                Stat().log('%s: %s', self.title, len(self._result))
+        return self._result
+
+    def _load_or_run(self):
+        if self.cache and os.path.exists(self.cache):
+            with open(self.cache, 'rb') as cache_file:
+                return self.loader.load(cache_file)
+        result = self.op(*(arg.result if isinstance(arg, _CachedOp) else arg
+                           for arg in self.args))
+        if self.cache:
+            _write_replace(self.cache, lambda cache_file: self.loader.dump(result, cache_file))
+        return result
+
+
+def _write_replace(file_name, write, mode='wb'):
+    # written aside and renamed, an interrupted run leaves no partial file
+    with tempfile.NamedTemporaryFile(mode, prefix=os.path.basename(file_name) + '.', suffix='.part',
+                                     dir=os.path.dirname(file_name) or '.', delete=False) as file:
+        write(file)
+    os.replace(file.name, file_name)
+
+
+def partition_name(partitions, date, key, min_zoom, max_zoom, rel, country, output_format):
+    # the filters, the geometries key and the format are part of the name, other runs
+    # and runs on rebuilt geometries don't reuse the partition
+    return os.path.join(partitions, PARTITION_NAME % (
+        date, MIN_ZOOM if min_zoom is None else min_zoom,
+        MAX_ZOOM if max_zoom is None else max_zoom,
+        'rel%s' % rel if rel else country or 'world', key[:16], output_format))
+
+
+def is_partition_done(name):
+    return os.path.exists(name + PARTITION_DONE)
+
+
+def prune_partitions(partitions, names):
+    """Deletes the partitions of the folder which are not among names, of
+    other dates, filters or geometries."""
+    keep = set()
+    for name in names:
+        keep.update((os.path.basename(name), os.path.basename(name) + PARTITION_DONE))
+    pruned = [file_name for file_name in os.listdir(partitions)
+              if file_name.startswith('trends-') and file_name not in keep]
+    for file_name in pruned:
+        os.remove(os.path.join(partitions, file_name))
+    Stat().log('partitions: %s files pruned', len(pruned))
+
+
+def _write_partition(name, write):
+    """Writes a day partition, the marker is created only once it is complete."""
+    with open(name + PARTITION_PART, 'wb') as out:
+        write(out)
+    os.replace(name + PARTITION_PART, name)
+    open(name + PARTITION_DONE, 'w').close()
+    return name, False
+
+
+def merge_partitions(out, folders, date_from=None, date_to=None,
+                     min_zoom=None, max_zoom=None, rel=None, country=None, output_format='csv'):
+    """Writes the done partitions of the folders of shard runs in date order,
+    the same output as a single run over the dates."""
+    date_from = date_from or MIN_DATE
+    date_to = date_to or MAX_DATE
+    # only partitions of the current geometries are merged
+    key = cached_stages(rel, country)[-1].key
+    names = {}
+    for folder in folders:
+        for file_name in os.listdir(folder):
+            if not file_name.endswith(PARTITION_DONE):
+                continue
+            date = file_name[len('trends-'):len('trends-YYYY-MM-DD')]
+            name = partition_name(folder, date, key, min_zoom, max_zoom, rel, country, output_format)
+            if file_name == os.path.basename(name) + PARTITION_DONE and date_from <= date <= date_to:
+                names.setdefault(date, name)
+    Stat().log('merge: %s partitions', len(names))
+
+    if output_format == 'records':
+        Tile_Records.write_header(out, RECORD_FIELDS)
+    for date in sorted(names):
+        with open(names[date], 'rb') as part:
+            shutil.copyfileobj(part, out)
+
+
+def merge_tile_caches(file_names, tile_cache_size=TILE_CACHE_SIZE):
+    """Merges the tile caches of shard runs into the same cache file in the
+    current folder, entries of the later files are the most recently used."""
+    base_names = {os.path.basename(file_name) for file_name in file_names}
+    if len(base_names) != 1:
+        raise ValueError('tile caches of different geometries: %s' % ', '.join(sorted(base_names)))
+    cache = TileCache(tile_cache_size)
+    for file_name in file_names:
+        with open(file_name) as cache_file:
+            for key, country in TileCache.load(cache_file, tile_cache_size).entries.items():
+                cache[key] = country
+    _write_replace(base_names.pop(), lambda cache_file: TileCache.dump(cache, cache_file), 'w')
+    Stat().log('merge: %s cached tiles', len(cache))
+
+
+def shard_of(date, shards):
+    # consecutive days go to different shards, whatever the range is
+    return datetime.datetime.strptime(date, '%Y-%m-%d').toordinal() % shards
+
+
+def _shard(value):
+    try:
+        shard, shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard is not i/N: %s' % value)
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError('shard is not in 0..N-1: %s' % value)
+    return shard, shards
+
+
+def _copy_outputs(out, links, pending, names, outputs):
+    """Copies the outputs of links to out in date order, the ones of pending
+    links come from outputs as (file name, temporary) in the same order."""
+    outputs = iter(outputs)
+    for link in links:
+        name, temporary = next(outputs) if link in pending else (names[link], False)
+        with open(name, 'rb') as part:
+            shutil.copyfileobj(part, out)
+        if temporary:
+            os.remove(name)
+
+
+def _process_item_worker(link):
+    # returns the output name, whether it is temporary, the tiles cached and the stat of the day
+    state = _worker_state
+    state['cache'].added = collections.OrderedDict()
+    stats = []
+
+    def write(out):
+        stats.append(process_item(out, state['tile_quadtree'], state['cache'], link,
+                                  SPLIT_ZOOM, state['tiled_countries'], state['grouped_countries'],
+                                  state['min_zoom'], state['max_zoom'], state['skip_empty_tiles'],
+                                  state['output_format']))
+
+    if link in state['partition_names']:
+        name, temporary = _write_partition(state['partition_names'][link], write)
+    else:
+        with tempfile.NamedTemporaryFile(prefix='trends-', suffix='.part',
+                                         dir=state['tmp_dir'], delete=False) as out:
+            write(out)
+        name, temporary = out.name, True
+    return name, temporary, list(state['cache'].added.items()), stats[0]
+
+
+def cached_stages(rel=None, country=None, workers=None):
+    """The cached ops of the countries grouped with empty tiles, the tiled
+    countries and the tile quadtree, nothing is loaded or computed yet."""
+    # caches of regional runs are kept per relation or country as their
+    # parameters are part of the cache keys
+    full_countries = _CachedOp(
         get_countries, rel, country,
-        title='total countries', cache=use_cache and GEOM_CACHE)
-    grouped_countries = _cached_op(
+        title='total countries', cache=GEOM_CACHE,
+        params=[COUNTRIES_QUERY, RELATION_QUERY, COUNTRIES_IDS_SKIP, FETCH_GEOMETRY_LINK,
+                rel, country])
+    grouped_countries = _CachedOp(
         group_geoms, full_countries,
-        title='grouped countries', cache=use_cache and GROUPED_GEOM_CACHE)
-    tiled_countries = _cached_op(
-        slice_geoms_to_tiles, grouped_countries,
-        title='total parts', cache=use_cache and SLICED_TO_TILES_GEOM_CACHE)
-    grouped_countries = _cached_op(
+        title='grouped countries', cache=GROUPED_GEOM_CACHE,
+        params=[MIN_INTERSECTION_AREA, MIN_INTERSECTION_AREA_PER_PERIMETER,
+                MIN_GEOMETRY_AREA_PER_PERIMETER])
+    tiled_countries = _CachedOp(
+        slice_geoms_to_tiles, grouped_countries, workers,
+        title='total parts', cache=SLICED_TO_TILES_GEOM_CACHE,
+        loader=TiledGeoms, params=[SPLIT_ZOOM])
+    grouped_countries = _CachedOp(
         add_no_country_items, grouped_countries, tiled_countries,
-        title='grouped with empty', cache=use_cache and GROUPED_GEOM_WITH_EMPTY_CACHE)
-    min_cache_zoom, cache = _cached_op(
-        create_cache, SPLIT_ZOOM, tiled_countries, grouped_countries, min_cache_zoom,
-        cache=use_cache and TILE_CACHE, loader=json, block=False)
+        title='grouped with empty', cache=GROUPED_GEOM_WITH_EMPTY_CACHE)
+    simplified_countries = _CachedOp(
+        simplify_geoms, grouped_countries,
+        title='simplified zoom bands', cache=SIMPLIFIED_GEOM_CACHE, params=[SIMPLIFY_ZOOMS])
+    # for a region the quadtree is its tile cover: tiles outside resolve to
+    # '??' and only tiles below its boundary leaves are tested on geometries
+    quadtree_max_zoom = REGION_QUADTREE_MAX_ZOOM if rel or country else QUADTREE_MAX_ZOOM
+    tile_quadtree = _CachedOp(
+        create_tile_quadtree, SPLIT_ZOOM, tiled_countries, grouped_countries, quadtree_max_zoom,
+        simplified_countries, title='quadtree nodes', cache=TILE_QUADTREE_CACHE, loader=TileQuadtree,
+        params=[SPLIT_ZOOM, quadtree_max_zoom])
+    return grouped_countries, tiled_countries, tile_quadtree
+
+
+def process_all(out, date_from=None, date_to=None,
+                min_zoom=None, max_zoom=None,
+                rel=None, country=None, workers=None, output_format='csv',
+                partitions=None, tile_cache_size=TILE_CACHE_SIZE, shard=None, metrics=None,
+                prune=False, keep_tile_logs=False):
+    if metrics:
+        # line buffered appends, forked workers write whole lines
+        Stat.metrics = open(metrics, 'a', buffering=1)
+    grouped_countries, tiled_countries, tile_quadtree = cached_stages(rel, country, workers)
+    # the tile cache and the partitions are kept per geometries
+    key = tile_quadtree.key
+    # tiles the quadtree can't resolve, the hot ones are kept for the next runs
+    tile_cache = '%s.%s%s' % (
+        os.path.splitext(TILE_CACHE)[0], key[:16], os.path.splitext(TILE_CACHE)[1])
+    if os.path.exists(tile_cache):
+        with open(tile_cache) as cache_file:
+            cache = TileCache.load(cache_file, tile_cache_size)
+    else:
+        cache = TileCache(tile_cache_size)
+    tile_quadtree = tile_quadtree.result
+    tiled_countries = tiled_countries.result
+    grouped_countries = grouped_countries.result
+
+    if output_format == 'records':
+        # worker parts and days are written as headerless chunks
+        Tile_Records.write_header(out, RECORD_FIELDS)
+    links = get_tile_usage_dump_links(date_from, date_to)
+    if not keep_tile_logs:
+        # the dumps of the days before the range are not needed anymore
+        prune_tile_usage_dumps(date_from)
+    if shard:
+        links = [link for link in links if shard_of(get_date_from_link(link), shard[1]) == shard[0]]
+        Stat().log('shard %s/%s: %s days', shard[0], shard[1], len(links))
+    names = {}
+    if partitions:
+        # one output per day, days processed by previous runs are only copied
+        os.makedirs(partitions, exist_ok=True)
+        names = {link: partition_name(partitions, get_date_from_link(link), key,
+                                      min_zoom, max_zoom, rel, country, output_format)
+                 for link in links}
+        if prune:
+            prune_partitions(partitions, names.values())
+    pending = [link for link in links if link not in names or not is_partition_done(names[link])]
+    if partitions:
+        Stat().log('partitions: %s done, %s to process', len(links) - len(pending), len(pending))
+
+    # the days are added to the stat of the run
+    stat = Stat()
+    start = time.perf_counter()
+    if workers and workers > 1 and len(pending) > 1:
+        os.makedirs(DUMPS_CACHE_FOLDER, exist_ok=True)
+        _worker_state.update(
+            tile_quadtree=tile_quadtree, cache=cache,
+            tiled_countries=tiled_countries, grouped_countries=grouped_countries,
+            min_zoom=min_zoom, max_zoom=max_zoom, skip_empty_tiles=rel or country,
+            output_format=output_format, partition_names=names,
+            # days written ahead of the in order copy can be big, they are kept
+            # beside the dumps instead of the system temporary folder
+            tmp_dir=tempfile.mkdtemp(prefix='trends-', dir=DUMPS_CACHE_FOLDER))
+
+        def merge_cached(results):
+            # tiles cached by the workers go to the tile cache in date order
+            for name, temporary, entries, day_stat in results:
+                for tile, iso in entries:
+                    cache[tile] = iso
+                stat.merge(day_stat)
+                yield name, temporary
 
-    for link in get_tile_usage_dump_links(date_from, date_to):
-        process_item(out, min_cache_zoom, cache, link,
-                     SPLIT_ZOOM, tiled_countries, grouped_countries,
-                     min_zoom, max_zoom, rel or country)
-        if use_cache:
-            with open(TILE_CACHE, 'w') as tile_cache_file:
-                json.dump([min_cache_zoom, cache], tile_cache_file)
+        try:
+            # fork shares the geometry structures and the mapped quadtree with
+            # workers without pickling, imap keeps the results in date order
+            with multiprocessing.get_context('fork').Pool(
+                    min(workers, len(pending))) as pool:
+                _copy_outputs(out, links, set(pending), names,
+                              merge_cached(pool.imap(_process_item_worker, pending)))
+        finally:
+            shutil.rmtree(_worker_state['tmp_dir'], ignore_errors=True)
+            _worker_state.clear()
+        _write_replace(tile_cache, lambda cache_file: TileCache.dump(cache, cache_file), 'w')
+        stat.log_stages('all', time.perf_counter() - start)
+        stat.log_metrics('all', time.perf_counter() - start, cache)
+        return
+
+    pending_links = prefetch_tile_usage_dumps(pending)
+    if partitions:
+        def write(link):
+            return _write_partition(names[link], lambda part: stat.merge(process_item(
+                part, tile_quadtree, cache, link,
+                SPLIT_ZOOM, tiled_countries, grouped_countries,
+                min_zoom, max_zoom, rel or country, output_format)))
+        _copy_outputs(out, links, set(pending), names, map(write, pending_links))
+    else:
+        for link in pending_links:
+            stat.merge(process_item(out, tile_quadtree, cache, link,
+                                    SPLIT_ZOOM, tiled_countries, grouped_countries,
+                                    min_zoom, max_zoom, rel or country, output_format))
+    _write_replace(tile_cache, lambda cache_file: TileCache.dump(cache, cache_file), 'w')
+    # the days only wait for the downloads, the prefetch time is the download time
+    stat.phases.pop('download', None)
+    stat.add_time('download', pending_links.busy, pending_links.busy_cpu)
+    stat.log_stages('all', time.perf_counter() - start)
+    stat.log_metrics('all', time.perf_counter() - start, cache)
 
 
 if __name__ == '__main__':
@@ -498,6 +1497,33 @@ if __name__ == '__main__':
     parser.add_argument('--max_zoom', type=int, default=None, help='filter to zoom (max 19)')
     parser.add_argument('--rel', type=int, default=None, help='filter by OSM relation id geometry')
     parser.add_argument('--country', default=None, help='filter by country ISO3166 alpha 2 code OSM geometry')
-    parser.add_argument('--min_cache_zoom', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None, help='process days in parallel with N processes')
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default='csv',
+                        help='csv lines or binary columnar records (see Tile_Records.py)')
+    parser.add_argument('--keep_tile_logs', action='store_true',
+                        help='keep the downloaded tile logs of the days before date_from')
+    parser.add_argument('--tile_cache_size', type=int, default=TILE_CACHE_SIZE,
+                        help='max count of tiles cached beside the quadtree')
+    parser.add_argument('--partitions', default=None,
+                        help='keep one output per day in this folder and process only missing days')
+    parser.add_argument('--prune', action='store_true',
+                        help='delete the files of the partitions folder which are not partitions of this run')
+    parser.add_argument('--metrics', default=None,
+                        help='append JSON lines of metrics per day and per run to this file')
+    parser.add_argument('--shard', type=_shard, default=None,
+                        help='process only the days of shard i of N (i/N)')
+    parser.add_argument('--merge', nargs='+', default=None,
+                        help='write the partitions of shard runs in these folders instead of processing')
+    parser.add_argument('--merge_tile_caches', nargs='+', default=None,
+                        help='merge these tile caches of shard runs into the current folder')
     stdout = sys.stdout if sys.version_info.major == 2 else sys.stdout.buffer
-    process_all(stdout, **parser.parse_args().__dict__)
+    args = parser.parse_args().__dict__
+    merge = args.pop('merge')
+    tile_caches = args.pop('merge_tile_caches')
+    if tile_caches:
+        merge_tile_caches(tile_caches, args['tile_cache_size'])
+    if merge:
+        merge_partitions(stdout, merge, args['date_from'], args['date_to'], args['min_zoom'],
+                         args['max_zoom'], args['rel'], args['country'], args['output_format'])
+    elif not tile_caches:
+        process_all(stdout, **args)
@@ -0,0 +1,120 @@
+"""Binary columnar stream of tile rows, an alternative to the CSV files
+passed between Fetch2.py, Bubble.py and Top_Trending.py.
+
+Layout, all integers little endian:
+
+- the magic ``b'TREC1\\n'``
+- uint32 size and a JSON header ``{"fields": [[name, type], ...]}``, the
+  type is a NumPy type string (``'<i8'``, ``'<f8'``, ...) or ``'dict'`` for
+  dictionary encoded strings
+- chunks until the end of the stream, each made of the uint32 rows count,
+  the uint32 size and JSON of the chunk dictionaries ``{name: [values]}``,
+  then every column as a contiguous array, dictionary columns as uint32
+  codes into their chunk dictionary
+
+Chunks don't depend on each other, so streams without their header can be
+concatenated, e.g. the parts written by parallel workers.
+"""
+import json
+import struct
+
+import numpy as np
+
+
+MAGIC = b'TREC1\n'
+DICTIONARY = 'dict'
+_SIZE = struct.Struct('<I')
+
+
+def is_records(stream):
+    # stdin and files opened in binary mode can be peeked without consuming
+    peek = getattr(stream, 'peek', None)
+    return peek is not None and peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+
+
+def write_header(out, fields):
+    header = json.dumps({'fields': fields}).encode()
+    out.write(MAGIC + _SIZE.pack(len(header)) + header)
+
+
+def write_chunk(out, fields, columns):
+    """Writes columns by field name, a string for a dictionary field is a
+    constant column."""
+    rows = None
+    for name, _type in fields:
+        if not isinstance(columns[name], str):
+            rows = len(columns[name])
+            break
+
+    dictionaries = {}
+    arrays = []
+    for name, _type in fields:
+        column = columns[name]
+        if _type != DICTIONARY:
+            arrays.append(np.ascontiguousarray(column, dtype=_type))
+        elif isinstance(column, str):
+            dictionaries[name] = [column]
+            arrays.append(np.zeros(rows, dtype='<u4'))
+        else:
+            index = {}
+            codes = [index.setdefault(value, len(index)) for value in column]
+            dictionaries[name] = list(index)
+            arrays.append(np.array(codes, dtype='<u4'))
+
+    dictionaries = json.dumps(dictionaries).encode()
+    out.write(_SIZE.pack(rows) + _SIZE.pack(len(dictionaries)) + dictionaries)
+    for array in arrays:
+        out.write(array.tobytes())
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise EOFError('truncated tile records stream')
+    return data
+
+
+def read_header(stream):
+    if _read(stream, len(MAGIC)) != MAGIC:
+        raise ValueError('not a tile records stream')
+    size, = _SIZE.unpack(_read(stream, _SIZE.size))
+    return [tuple(field) for field in json.loads(_read(stream, size).decode())['fields']]
+
+
+def _read_chunks(stream, fields):
+    while True:
+        head = stream.read(2 * _SIZE.size)
+        if not head:
+            return
+        if len(head) != 2 * _SIZE.size:
+            raise EOFError('truncated tile records stream')
+        rows, size = struct.unpack('<II', head)
+        dictionaries = json.loads(_read(stream, size).decode())
+
+        columns = {}
+        for name, _type in fields:
+            dtype = np.dtype('<u4' if _type == DICTIONARY else _type)
+            column = np.frombuffer(_read(stream, rows * dtype.itemsize), dtype=dtype)
+            if _type == DICTIONARY:
+                column = np.array(dictionaries[name], dtype=object)[column]
+            columns[name] = column
+        yield columns
+
+
+def read_chunks(stream):
+    """Yields the fields and a dict of column arrays per chunk, dictionary
+    columns decoded to object arrays."""
+    fields = read_header(stream)
+    for columns in _read_chunks(stream, fields):
+        yield fields, columns
+
+
+def read_columns(stream):
+    """Reads the whole stream into one array per field, in field order."""
+    fields = read_header(stream)
+    chunks = list(_read_chunks(stream, fields))
+    columns = {}
+    for name, _type in fields:
+        dtype = object if _type == DICTIONARY else np.dtype(_type)
+        columns[name] = np.concatenate([chunk[name] for chunk in chunks] or [np.empty(0, dtype=dtype)])
+    return columns
@@ -0,0 +1,38 @@
+"""Web mercator tile math on arrays, shared by Fetch2.py and Bubble.py.
+
+Results are bit identical to ``mercantile.bounds``: longitudes use the same
+float operations on arrays, latitudes are computed with the math module once
+per distinct zoom and row, as NumPy's transcendental functions may differ
+from it in the last bit.
+"""
+import math
+
+import numpy as np
+
+
+def tile_lat(y, z2):
+    # latitude of the north edge of the tile row y of the zoom with z2 = 2 ** z tiles
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / z2))))
+
+
+def tiles_bounds(zs, xs, ys):
+    # west, south, east and north arrays of the tiles
+    z2 = np.ldexp(1.0, zs)
+    west = xs / z2 * 360.0 - 180.0
+    east = (xs + 1) / z2 * 360.0 - 180.0
+
+    # latitudes only depend on (z, y), evaluate them once per distinct row
+    edges = np.concatenate([(zs << 21) | ys, (zs << 21) | (ys + 1)])
+    keys, inverse = np.unique(edges, return_inverse=True)
+    lats = np.array([tile_lat(k & 0x1fffff, 2.0 ** (k >> 21)) for k in keys.tolist()],
+                    dtype=np.float64)
+    lats = lats[inverse.reshape(-1)]
+    north, south = lats[:len(zs)], lats[len(zs):]
+    return west, south, east, north
+
+
+def tiles_centers(zs, xs, ys):
+    # lat and lon arrays of the points written for the tiles, the latitude is
+    # the north edge plus half the height as it has always been computed
+    west, south, east, north = tiles_bounds(zs, xs, ys)
+    return north + (north - south) / 2, west + (east - west) / 2
@@ -5,6 +5,7 @@ import pandas as pd
 import matplotlib
 import datetime as dt
 import itertools as it
+import Tile_Records
 from Caches import Cache
 from Database import TrendingDb
 from Reverse_Geocoding import ReverseGeoCode
@@ -213,7 +214,11 @@ def analyze_data(stdin, date, period, count, graph, country):
         date = MAX_DATE if date > MAX_DATE else date
     period = MIN_PERIOD if period < MIN_PERIOD else period
     if not cache.existing(RESAMPLE + str(date.date())):
-        tile_data = pd.read_csv(stdin, sep=',', parse_dates=['data'], keep_default_na=False)
+        if Tile_Records.is_records(stdin):
+            tile_data = pd.DataFrame(Tile_Records.read_columns(stdin))
+            tile_data['data'] = pd.to_datetime(tile_data['data'])
+        else:
+            tile_data = pd.read_csv(stdin, sep=',', parse_dates=['data'], keep_default_na=False)
         tile_data.rename(columns={'data': 'date'}, inplace=True)
         if not check_data_validity(tile_data, period):
             raise AssertionError('Data is missing')
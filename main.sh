@@ -64,7 +64,7 @@ trap exitprocTERM TERM
 trap exitprocKILL KILL
 trap exitprocEXIT EXIT
 
-logged_cmd "python3 Fetch2.py --date_from=$date_from --date_to=$date_to >${output_dir}Trends.csv"
+logged_cmd "python3 Fetch2.py --date_from=$date_from --date_to=$date_to --partitions=${output_dir}trends --prune --metrics=${output_dir}metrics.jsonl >${output_dir}Trends.csv"
 logged_cmd "test -r ${output_dir}Trends.csv && cat ${output_dir}Trends.csv | python3 Bubble.py --date_precision=1d --min_zoom=10 --max_zoom=19 --min_subz=10 --max_subz=10 --no_per_day >${output_dir}Zoom10Tiles.csv"
 logged_cmd "test -r ${output_dir}Zoom10Tiles.csv && cat ${output_dir}Zoom10Tiles.csv | python3 Top_Trending.py --graph --date=$date_to"
 logged_cmd "python3 Trending_Bot.py"